@@ -0,0 +1,191 @@
+import bisect
+import functools
+import json
+import os
+import pathlib
+import re
+
+import cache
+import mmif_cache
+from utils import get_properties, get_status
+
+"""
+Per-view row index for the annotations table. Every view gets one JSON file in
+the visualization directory with one row per annotation, written once, so that
+the table can be served in pages without touching the MMIF again, and a token
+index (lowercased words to the rows they occur in) used to search the rows.
+"""
+
+ROWS_DIRNAME = "rows"
+# columns of a row, in order
+COLUMNS = ("id", "type", "properties")
+# maximum number of rows served by one request
+MAX_PAGE_LENGTH = 500
+# long property values are cut off in the table
+_MAX_PROPERTIES_LENGTH = 500
+
+
+_TOKEN = re.compile(r"\w+")
+
+
+def get_rows_path(viz_id, view_id):
+    return cache.get_cache_root() / viz_id / _rows_filename(view_id)
+
+
+def get_tokens_path(viz_id, view_id):
+    return cache.get_cache_root() / viz_id / _tokens_filename(view_id)
+
+
+def _rows_filename(view_id):
+    return pathlib.Path(ROWS_DIRNAME) / f"{view_id.replace(':', '-')}.json"
+
+
+def _tokens_filename(view_id):
+    return pathlib.Path(ROWS_DIRNAME) / f"{view_id.replace(':', '-')}.tokens.json"
+
+
+def limit_len(s):
+    return s[:_MAX_PROPERTIES_LENGTH] + "  . . .  }" if len(s) > _MAX_PROPERTIES_LENGTH else s
+
+
+def build_row_index(mmif, viz_id, view_ids=None):
+    """
+    Writes the row index of every view that does not have one yet, or only of
+    the given views, and returns the header information of all views.
+    """
+    os.makedirs(cache.get_cache_root() / viz_id / ROWS_DIRNAME, exist_ok=True)
+    views = []
+    for view in mmif.views:
+        views.append({"id": view.id, "app": view.metadata.app, "status": get_status(view),
+                      "count": len(view.annotations)})
+        if view_ids is not None and view.id not in view_ids or os.path.exists(get_rows_path(viz_id, view.id)):
+            continue
+        rows = [[annotation.id, annotation.at_type.shortname, limit_len(get_properties(annotation))]
+                for annotation in view.annotations]
+        # the rows are written last, their presence marks a complete index
+        cache.write_artifact(viz_id, _tokens_filename(view.id), json.dumps(index_tokens(rows)))
+        cache.write_artifact(viz_id, _rows_filename(view.id), json.dumps(rows))
+    return views
+
+
+def index_tokens(rows):
+    """
+    Returns the positions of the rows each lowercased word occurs in.
+    """
+    tokens = {}
+    for i, row in enumerate(rows):
+        for token in set(_TOKEN.findall(" ".join(row).lower())):
+            tokens.setdefault(token, []).append(i)
+    return tokens
+
+
+def ensure_row_index(viz_id, view_id):
+    """
+    Builds the row index of a view if it is missing, for instance when the table
+    is queried before its tab was rendered or the view was left out of it. Returns
+    whether the view has rows, which is False for unknown view IDs.
+    """
+    if not os.path.exists(get_rows_path(viz_id, view_id)):
+        with cache.file_lock(f"rows-{viz_id}"):
+            if not os.path.exists(get_rows_path(viz_id, view_id)):
+                build_row_index(mmif_cache.get_mmif(viz_id), viz_id, [view_id])
+    return os.path.exists(get_rows_path(viz_id, view_id))
+
+
+def query_rows(viz_id, view_id, start=0, length=50, sort=None, descending=False, search=None):
+    """
+    Returns one page of the rows of a view, optionally sorted by a column and
+    restricted to rows where any column contains the (case-insensitive) search
+    string, along with the total and the filtered number of rows.
+    """
+    rows = get_rows(viz_id, view_id)
+    selected = select_rows(viz_id, view_id, sort, descending, search)
+    start = max(start, 0)
+    length = min(max(length, 0), MAX_PAGE_LENGTH)
+    return {"total": len(rows),
+            "filtered": len(selected),
+            "start": start,
+            "rows": [rows[i] for i in selected[start:start + length]]}
+
+
+def get_rows(viz_id, view_id):
+    path = get_rows_path(viz_id, view_id)
+    return _load_rows(str(path), os.stat(path).st_mtime_ns)
+
+
+def select_rows(viz_id, view_id, sort=None, descending=False, search=None):
+    """
+    Returns the positions of the matching rows of a view (which are also the
+    positions of the annotations in the view) in display order.
+    """
+    path = get_rows_path(viz_id, view_id)
+    tokens_path = get_tokens_path(viz_id, view_id)
+    return _select_rows(str(path), os.stat(path).st_mtime_ns, str(tokens_path), os.stat(tokens_path).st_mtime_ns,
+                        sort, descending, (search or "").lower())
+
+
+@functools.lru_cache(maxsize=32)
+def _load_rows(path, mtime_ns):
+    # keyed by modification time, so that a re-rendered view is read again
+    with open(path) as f:
+        return json.load(f)
+
+
+@functools.lru_cache(maxsize=8)
+def _load_tokens(path, mtime_ns):
+    """
+    Returns the token index along with every suffix of every token, sorted, and
+    the token of each suffix. The tokens containing a word are the tokens of the
+    suffixes starting with it, which are next to each other in sorted order.
+    """
+    with open(path) as f:
+        tokens = json.load(f)
+    suffixes = sorted((token[i:], token) for token in tokens for i in range(len(token)))
+    return tokens, [suffix for suffix, _ in suffixes], [token for _, token in suffixes]
+
+
+@functools.lru_cache(maxsize=128)
+def _select_rows(path, mtime_ns, tokens_path, tokens_mtime_ns, sort, descending, search):
+    # memoized, so that paging through a sorted or filtered table sorts and
+    # filters only once
+    rows = _load_rows(path, mtime_ns)
+    selected = range(len(rows))
+    if search:
+        selected = _search_candidates(_load_tokens(tokens_path, tokens_mtime_ns), search, len(rows))
+        selected = [i for i in selected if any(search in value.lower() for value in rows[i])]
+    if sort in COLUMNS:
+        column = COLUMNS.index(sort)
+        selected = sorted(selected, key=lambda i: _natural_key(rows[i][column]), reverse=descending)
+    elif descending:
+        selected = selected[::-1]
+    return tuple(selected)
+
+
+def _search_candidates(token_index, search, n_rows):
+    """
+    Returns the positions of the rows that may contain the search string, in
+    order: the rows having, for every word of the search string, a word that
+    contains it. Only these rows need to be checked for the whole string.
+    """
+    tokens, suffixes, suffix_tokens = token_index
+    words = _TOKEN.findall(search)
+    if not words:
+        # nothing to look up, like a search for punctuation
+        return range(n_rows)
+    candidates = None
+    for word in set(words):
+        start = end = bisect.bisect_left(suffixes, word)
+        while end < len(suffixes) and suffixes[end].startswith(word):
+            end += 1
+        matches = set()
+        for token in set(suffix_tokens[start:end]):
+            matches.update(tokens[token])
+        candidates = matches if candidates is None else candidates & matches
+        if not candidates:
+            break
+    return sorted(candidates)
+
+
+def _natural_key(s):
+    # so that "tf_2" comes before "tf_10"
+    return [(0, int(part), "") if part.isdigit() else (1, 0, part) for part in re.split(r"(\d+)", s)]
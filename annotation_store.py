@@ -0,0 +1,105 @@
+import json
+import os
+import pathlib
+from io import BytesIO
+
+import numpy as np
+
+import cache
+import mmif_cache
+
+"""
+Columnar copy of the annotations of each view, written once per upload to the
+visualization directory as one .npy file per column, so that summaries over
+many annotations (counts by type) are array operations on memory-mapped files
+instead of loops over parsed Annotation objects.
+
+Every view has these columns, with one entry per annotation in view order:
+
+- type: index into the "types" string table (type shortnames)
+
+The string tables are stored in strings.json.
+"""
+
+STORE_DIRNAME = "columns"
+COLUMNS = ("type",)
+_STRINGS_FILENAME = "strings.json"
+
+
+def get_view_dir(viz_id, view_id):
+    return cache.get_cache_root() / viz_id / _view_rel_dir(view_id)
+
+
+def _view_rel_dir(view_id):
+    return pathlib.Path(STORE_DIRNAME) / view_id.replace(':', '-')
+
+
+def build_store(mmif, viz_id):
+    """
+    Writes the columns of every view that does not have them yet.
+    """
+    for view in mmif.views:
+        if not os.path.exists(get_view_dir(viz_id, view.id) / _STRINGS_FILENAME):
+            write_view(view, viz_id)
+
+
+def write_view(view, viz_id):
+    types = {}
+    columns = {"type": np.fromiter((types.setdefault(annotation.at_type.shortname, len(types))
+                                    for annotation in view.annotations),
+                                   dtype=np.int32, count=len(view.annotations))}
+
+    view_dir = _view_rel_dir(view.id)
+    os.makedirs(cache.get_cache_root() / viz_id / view_dir, exist_ok=True)
+    for name, column in columns.items():
+        cache.write_artifact(viz_id, view_dir / f"{name}.npy", _to_npy_bytes(column))
+    # written last, its presence marks a complete store
+    cache.write_artifact(viz_id, view_dir / _STRINGS_FILENAME, json.dumps({"types": list(types)}))
+
+
+def _to_npy_bytes(array):
+    buffer = BytesIO()
+    np.save(buffer, array)
+    return buffer.getvalue()
+
+
+def get_view_store(viz_id, view_id):
+    """
+    Returns the columns of a view, memory-mapped, building the store first if
+    the visualization was rendered without it.
+    """
+    view_dir = get_view_dir(viz_id, view_id)
+    if not os.path.exists(view_dir / _STRINGS_FILENAME):
+        with cache.file_lock(f"columns-{viz_id}"):
+            if not os.path.exists(view_dir / _STRINGS_FILENAME):
+                build_store(mmif_cache.get_mmif(viz_id), viz_id)
+    return ViewStore(view_dir)
+
+
+class ViewStore():
+
+    def __init__(self, view_dir):
+        with open(view_dir / _STRINGS_FILENAME) as f:
+            strings = json.load(f)
+        self.types = strings["types"]
+        for name in COLUMNS:
+            setattr(self, name, np.load(view_dir / f"{name}.npy", mmap_mode="r"))
+
+    def __len__(self):
+        return len(self.type)
+
+    def count_types(self):
+        """
+        Returns the number of annotations of each type, in order of first
+        occurrence like a Counter over the annotations would.
+        """
+        counts = np.bincount(self.type, minlength=len(self.types))
+        return {shortname: int(count) for shortname, count in zip(self.types, counts)}
+
+    def select_type(self, shortname):
+        """
+        Returns the positions of the annotations of one type.
+        """
+        if shortname not in self.types:
+            return np.empty(0, dtype=np.intp)
+        return np.flatnonzero(self.type == self.types.index(shortname))
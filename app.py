@@ -1,24 +1,73 @@
 import hashlib
+import mimetypes
 import os
+import pathlib
 import secrets
 import sys
-from threading import Thread
-from shutil import rmtree
+import threading
+import time
 
-from flask import Flask, request, render_template, flash, send_from_directory, redirect
-from mmif.serialize import Mmif
-from mmif.vocabulary import DocumentTypes
+from flask import Flask, request, render_template, flash, send_from_directory, send_file, redirect, jsonify, abort
+from werkzeug.security import safe_join
 
 import cache
+import config
+import displacy
+import jobs
+import metrics
+import mmif_cache
+import tree
+import validation
+from annotation_rows import ensure_row_index, query_rows
+from annotation_store import build_store
+from costs import get_plan, FULL
 from cache import set_last_access, cleanup
 import traceback
-from render import render_documents, render_annotations, prepare_ocr, render_ocr_page
+from render import render_documents, render_annotations, count_tabs, get_tab, get_tab_ids, render_ocr_page, warm_up
 
 # these two static folder-related params are important, do not remove
 app = Flask(__name__, static_folder='static', static_url_path='')
 app.secret_key = 'your_secret_key_here'
 
 
+metrics.Gauge("mmif_viz_cache_size_bytes", "Size of the visualizations in the cache", cache.get_cache_size)
+metrics.Gauge("mmif_viz_render_queue_depth", "Render jobs of this process that are queued or running",
+              jobs.get_queue_depth)
+metrics.Gauge("mmif_viz_parsed_mmif_files", "Parsed MMIF files kept in memory by this process",
+              lambda: mmif_cache.get_memory_usage()[0])
+metrics.Gauge("mmif_viz_parsed_mmif_estimated_bytes",
+              f"Estimated memory taken by the parsed MMIF files of this process "
+              f"({mmif_cache._MEMORY_FACTOR} times their JSON size)",
+              lambda: mmif_cache.get_memory_usage()[1])
+
+
+@app.before_request
+def start_request():
+    request.start_time = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    """
+    Records the time taken by a request, and reports the stages it went to in
+    the log and, if config.SERVER_TIMING is set, in a Server-Timing header.
+    """
+    elapsed = time.perf_counter() - request.start_time
+    metrics.REQUEST_SECONDS.observe(elapsed, endpoint=request.endpoint or "none", status=response.status_code)
+    breakdown = metrics.get_breakdown()
+    if breakdown:
+        app.logger.debug(f"{request.method} {request.path} took {1000 * elapsed:.1f} ms: "
+                         + ", ".join(f"{name} {1000 * seconds:.1f} ms" for name, seconds in breakdown.items()))
+    if config.SERVER_TIMING:
+        response.headers["Server-Timing"] = metrics.server_timing(breakdown, elapsed)
+    return response
+
+
+@app.route('/metrics')
+def metrics_endpoint():
+    return metrics.collect(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -65,11 +114,13 @@ def invalidate_cache():
     if not request.args.get('viz_id'):
         app.logger.debug("Invalidating entire cache.")
         cache.invalidate_cache()
+        mmif_cache.discard()
         return redirect("/upload")
     viz_id = request.args.get('viz_id')
     in_mmif = open(cache.get_cache_root() / viz_id / 'file.mmif', 'rb').read()
     app.logger.debug(f"Invalidating {viz_id} from cache.")
     cache.invalidate_cache([viz_id])
+    mmif_cache.discard([viz_id])
     return upload_file(in_mmif)
 
 
@@ -79,15 +130,151 @@ def display(viz_id):
     app.logger.debug(f"Displaying visualization {viz_id} from {path}")
     if os.path.exists(path / "index.html"):
         app.logger.debug(f"Visualization {viz_id} found in cache.")
+        metrics.count_lookup("page", hit=True)
         set_last_access(path)
-        with open(os.path.join(path, "index.html")) as f:
-            html_file = f.read()
-        return html_file
-    else:
-        app.logger.debug(f"Visualization {viz_id} not found in cache.")
-        rmtree(path)
-        flash("File not found -- please upload again (it may have been deleted to clear up cache space).")
-        return redirect("/upload")
+        return send_cached_file(viz_id, "index.html")
+    metrics.count_lookup("page", hit=False)
+    job_status = jobs.get_status(viz_id)
+    if job_status is not None and job_status["state"] in jobs.PENDING_STATES + ("error",):
+        app.logger.debug(f"Visualization {viz_id} is {job_status['state']}.")
+        return render_template('progress.html', viz_id=viz_id, status=job_status)
+    # Never delete the directory from under a render that is in flight
+    with cache.render_lock(viz_id, blocking=False) as acquired:
+        if acquired and not os.path.exists(path / "index.html"):
+            app.logger.debug(f"Visualization {viz_id} not found in cache.")
+            cache.evict(viz_id)
+    flash("File not found -- please upload again (it may have been deleted to clear up cache space).")
+    return redirect("/upload")
+
+
+@app.route('/display/<viz_id>/tab/<path:tab_id>')
+def display_tab(viz_id, tab_id):
+    """
+    Serves the contents of one tab of a visualization, rendering it on the first
+    request and caching it in the visualization directory.
+    """
+    path = cache.get_cache_root() / viz_id
+    if safe_join(str(cache.get_cache_root()), viz_id) is None or not os.path.exists(path / "file.mmif"):
+        return '<p class="error">Visualization not found, please upload the file again.</p>', 404
+    # tab IDs end up in file and lock names, only those of actual tabs are accepted
+    mmif = mmif_cache.get_mmif(viz_id)
+    if tab_id not in get_tab_ids(mmif):
+        return '<p class="error">Tab not found.</p>', 404
+    tab_filename = pathlib.Path("tabs") / f"{tab_id.replace(':', '-')}.html"
+    if safe_join(str(path), str(tab_filename)) is None:
+        return '<p class="error">Tab not found.</p>', 404
+    metrics.count_lookup("tab", hit=os.path.exists(path / tab_filename))
+    if not os.path.exists(path / tab_filename):
+        with cache.file_lock(f"tab-{viz_id}-{tab_filename.stem}"):
+            if not os.path.exists(path / tab_filename):
+                app.logger.debug(f"Rendering tab {tab_id} of {viz_id}")
+                tab = get_tab(mmif, viz_id, tab_id)
+                html = tab.render_html()
+                if tab.error is not None:
+                    # not cached, so that the next request tries again
+                    return html
+                os.makedirs(path / "tabs", exist_ok=True)
+                cache.write_artifact(viz_id, tab_filename, html, compress=True)
+    set_last_access(path)
+    return send_cached_file(viz_id, tab_filename)
+
+
+@app.route('/display/<viz_id>/annotations/<view_id>')
+def annotation_rows(viz_id, view_id):
+    """
+    Serves one page of the annotations table of a view as JSON. Query parameters
+    are start, length, sort (a column name), order (asc or desc) and search.
+    """
+    path = cache.get_cache_root() / viz_id
+    if not os.path.exists(path / "file.mmif"):
+        return {"error": "Visualization not found"}, 404
+    if not ensure_row_index(viz_id, view_id):
+        return {"error": f"View {view_id} not found"}, 404
+    try:
+        start = int(request.args.get('start', 0))
+        length = int(request.args.get('length', 50))
+    except ValueError:
+        return {"error": "start and length must be integers"}, 400
+    set_last_access(path)
+    return query_rows(viz_id, view_id, start, length,
+                      sort=request.args.get('sort') or None,
+                      descending=request.args.get('order') == 'desc',
+                      search=request.args.get('search'))
+
+
+@app.route('/display/<viz_id>/ner/<view_id>')
+def ner_window(viz_id, view_id):
+    """
+    Serves the window of the text of an NER view that starts at the start
+    parameter, as HTML along with the start of the next window.
+    """
+    if not os.path.exists(displacy.windows.get_index_path(viz_id, view_id)):
+        return {"error": f"Named entities of {view_id} not found"}, 404
+    try:
+        start = int(request.args.get('start', 0))
+    except ValueError:
+        return {"error": "start must be an integer"}, 400
+    html, next_start = displacy.visualize_ner_window(viz_id, view_id, start)
+    return {"html": html, "next": next_start}
+
+
+@app.route('/display/<viz_id>/tree')
+def tree_nodes(viz_id):
+    """
+    Serves the children of a node of the Tree tab as jsTree JSON, restricted to
+    annotations matching the search parameter if there is one.
+    """
+    if not os.path.exists(cache.get_cache_root() / viz_id / "file.mmif"):
+        return {"error": "Visualization not found"}, 404
+    mmif = mmif_cache.get_mmif(viz_id)
+    try:
+        nodes = tree.get_children(mmif, viz_id, request.args.get('id', '#'), request.args.get('search'))
+    except (KeyError, ValueError, IndexError):
+        return {"error": f"Node {request.args.get('id')} not found"}, 404
+    return jsonify(nodes)
+
+
+@app.route('/display/<viz_id>/tree/search')
+def tree_search(viz_id):
+    """
+    Reports the number of annotations matching the q parameter in each view.
+    """
+    if not os.path.exists(cache.get_cache_root() / viz_id / "file.mmif"):
+        return {"error": "Visualization not found"}, 404
+    query = request.args.get('q', '')
+    return {"query": query, "views": tree.search(mmif_cache.get_mmif(viz_id), viz_id, query)}
+
+
+@app.route('/status/<viz_id>')
+def status(viz_id):
+    """
+    Reports the progress of rendering a visualization, and the result of
+    validating its file if that is done in the background, as JSON.
+    """
+    job_status = jobs.get_status(viz_id)
+    if job_status is None:
+        if not os.path.exists(cache.get_cache_root() / viz_id / "index.html"):
+            return {"state": "unknown"}, 404
+        job_status = {"state": "done", "done": 0, "total": 0, "message": None}
+    job_status.pop("pid", None)
+    job_status["display_url"] = f"{request.url_root}display/{viz_id}"
+    job_status["validation"] = validation.get_result(viz_id)
+    return job_status
+
+
+@app.route(f'/{cache._CACHE_DIR_SUFFIX}/<viz_id>/<path:filename>')
+def send_cache_file(viz_id, filename):
+    """
+    Serves files from visualization (and thumbnail) directories. Thumbnails
+    never change under their URL, so browsers may keep them for good.
+    Everything else (the linked source documents, status and validation
+    results, OCR pages, captions...) can change and is revalidated with its
+    ETag, which for source documents follows the time the source was modified.
+    """
+    from thumbnails import is_thumbnail
+    if safe_join(str(cache.get_cache_root()), viz_id, filename) is None:
+        abort(404)
+    return send_cached_file(viz_id, filename, immutable=is_thumbnail(viz_id, filename))
 
 
 @app.route('/uv/<path:path>')
@@ -95,27 +282,47 @@ def send_js(path):
     return send_from_directory("uv", path)
 
 
-def render_mmif(mmif_str, viz_id):
-    mmif = Mmif(mmif_str)
-    rendered_documents = render_documents(mmif, viz_id)
-    rendered_annotations = render_annotations(mmif, viz_id)
+def render_mmif(mmif_str, viz_id, progress=None):
+    mmif = mmif_cache.get_mmif(viz_id, mmif_str)
+    with metrics.span("build_store"):
+        build_store(mmif, viz_id)
+    n_tabs = count_tabs(mmif)
+    rendered_documents = render_documents(mmif, viz_id, progress and (lambda n: progress(n, n_tabs)))
+    n_document_tabs = len(rendered_documents)
+    rendered_annotations = render_annotations(mmif, viz_id,
+                                              progress and (lambda n: progress(n_document_tabs + n, n_tabs)))
     return render_template('player.html',
                            docs=rendered_documents,
                            viz_id=viz_id,
                            annotations=rendered_annotations)
 
 
+def render_job(viz_id, progress, mmif_str):
+    """
+    Renders an uploaded file in the background, see upload_file().
+    """
+    with app.app_context(), cache.render_lock(viz_id):
+        if not os.path.exists(cache.get_cache_root() / viz_id / 'index.html'):
+            with metrics.span("render_page"):
+                html_page = render_mmif(mmif_str, viz_id, progress)
+            cache.write_artifact(viz_id, 'index.html', html_page, compress=True)
+    cleanup()
+
+
 def build_ocr_tab(data):
     """
     Prepares OCR (at load time, due to lazy loading)
     """
     try:
+        from mmif.vocabulary import DocumentTypes
+        from ocr import prepare_ocr
         data = dict(request.json)
-        mmif_str = open(cache.get_cache_root() /
-                        data["mmif_id"] / "file.mmif").read()
-        mmif = Mmif(mmif_str)
+        mmif = mmif_cache.get_mmif(data["mmif_id"])
         ocr_view = mmif.get_view_by_id(data["view_id"])
-        prepare_ocr(mmif, ocr_view, data["mmif_id"])
+        # views with many frames are decoded page by page, see costs.py
+        preextract = config.PREEXTRACT_FRAMES and get_plan(mmif, data["mmif_id"]).mode("ocr", ocr_view.id) == FULL
+        with metrics.span("prepare_ocr"):
+            prepare_ocr(mmif, ocr_view, data["mmif_id"], preextract)
         request.json["vid_path"] = mmif.get_documents_by_type(DocumentTypes.VideoDocument)[
                 0].location_path()
 
@@ -129,11 +336,42 @@ def serve_ocr_page(data):
     Serves subsequent OCR pages
     """
     try:
-        return render_ocr_page(data["mmif_id"], data['vid_path'], data["view_id"], data["page_number"])
+        with metrics.span("render_ocr_page"):
+            return render_ocr_page(data["mmif_id"], data['vid_path'], data["view_id"], data["page_number"])
     except Exception as e:
         return f'<p class="error">Unexpected error of type {type(e)}: {e}</h1>'
 
 
+def send_cached_file(viz_id, rel_path, immutable=False):
+    """
+    Serves a file from a visualization directory, or its precompressed variant
+    if the client accepts it, answering If-None-Match requests with 304 Not
+    Modified. The ETag is the visualization ID and the time the file was
+    written, so it changes when a visualization is rendered again.
+    """
+    path = cache.get_cache_root() / viz_id / rel_path
+    if not path.is_file():
+        abort(404)
+    name = path.name
+    mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    etag = f"{viz_id}-{path.stat().st_mtime_ns:x}"
+    encoding = None
+    for variant_encoding, variant_path in cache.get_variants(path):
+        if request.accept_encodings.quality(variant_encoding) > 0:
+            encoding, path = variant_encoding, variant_path
+            etag = f"{etag}-{encoding}"
+            break
+    # without a max age, send_file tells browsers to revalidate every time
+    response = send_file(path, mimetype=mimetype, etag=etag, conditional=True, download_name=name,
+                         max_age=31536000 if immutable else None)
+    if encoding is not None:
+        response.headers["Content-Encoding"] = encoding
+    response.vary.add("Accept-Encoding")
+    if immutable:
+        response.cache_control.immutable = True
+    return response
+
+
 def upload_file(in_mmif):
     # Save file locally
     in_mmif_bytes = in_mmif if isinstance(in_mmif, bytes) else in_mmif.read()
@@ -142,43 +380,80 @@ def upload_file(in_mmif):
     app.logger.debug(f"Visualization ID: {viz_id}")
     path = cache.get_cache_root() / viz_id
     app.logger.debug(f"Visualization Directory: {path}")
-    try:
-        os.makedirs(path)
-        set_last_access(path)
-        with open(path / 'file.mmif', 'w') as in_mmif_file:
-            app.logger.debug(f"Writing original MMIF to {path / 'file.mmif'}")
-            in_mmif_file.write(in_mmif_str)
-        html_page = render_mmif(in_mmif_str, viz_id)
-        with open(os.path.join(path, "index.html"), "w") as f:
-            f.write(html_page)
-    except FileExistsError:
-        app.logger.debug("Visualization already cached")
-    finally:
-        # Perform cleanup
-        t = Thread(target=cleanup)
-        t.daemon = True
-        t.run()
+    # Rendering happens in the background, the file is only queued here unless
+    # it is already rendered or queued by a concurrent upload of the same file.
+    # The render lock is held for the whole render, so it is not waited for
+    # while the file is being rendered, only while it is being evicted.
+    with cache.render_lock(viz_id, blocking=False) as acquired:
+        if acquired:
+            queue_render(viz_id, in_mmif_str)
+    if not acquired:
+        if jobs.is_pending(viz_id):
+            app.logger.debug("Visualization already being rendered")
+        else:
+            with cache.render_lock(viz_id):
+                queue_render(viz_id, in_mmif_str)
     agent = request.headers.get('User-Agent')
     if 'curl' in agent.lower():
-        return f"Visualization ID is {viz_id}\nYou can access the visualized file at {request.url_root}display/{viz_id}\n"
+        return (f"Visualization ID is {viz_id}\n"
+                f"You can access the visualized file at {request.url_root}display/{viz_id}\n"
+                f"Rendering progress is reported at {request.url_root}status/{viz_id}\n")
     return redirect(f"/display/{viz_id}", code=301)
 
 
-if __name__ == '__main__':
-    # Make path for temp files
+def queue_render(viz_id, in_mmif_str):
+    """
+    Queues the rendering of an uploaded file unless it is rendered or queued
+    already. Called with the render lock of the visualization held.
+    """
+    path = cache.get_cache_root() / viz_id
+    if os.path.exists(path / 'index.html'):
+        app.logger.debug("Visualization already cached")
+    elif jobs.is_pending(viz_id):
+        app.logger.debug("Visualization already being rendered")
+    else:
+        os.makedirs(path, exist_ok=True)
+        set_last_access(path)
+        app.logger.debug(f"Writing original MMIF to {path / 'file.mmif'}")
+        cache.write_artifact(viz_id, 'file.mmif', in_mmif_str)
+        jobs.submit(viz_id, render_job, in_mmif_str)
+        if config.FAST_LOAD:
+            validation.submit(viz_id, in_mmif_str)
+
+
+def setup():
+    """
+    Links the cache directory into the static folder and sets the session key.
+    Safe to call from every worker process of a multi-worker deployment.
+    """
     cache_path = cache.get_cache_root()
     cache_symlink_path = os.path.join(
         app.static_folder, cache._CACHE_DIR_SUFFIX)
-    if os.path.islink(cache_symlink_path):
-        os.unlink(cache_symlink_path)
-    elif os.path.exists(cache_symlink_path):
-        raise RuntimeError(f"Expected {cache_symlink_path} to be a symlink (for re-linking to a new cache dir, "
-                           f"but it is a real path.")
-    os.symlink(cache_path, cache_symlink_path)
+    with cache.file_lock("setup"):
+        if os.path.islink(cache_symlink_path):
+            if os.readlink(cache_symlink_path) != str(cache_path):
+                os.unlink(cache_symlink_path)
+        elif os.path.exists(cache_symlink_path):
+            raise RuntimeError(f"Expected {cache_symlink_path} to be a symlink (for re-linking to a new cache dir, "
+                               f"but it is a real path.")
+        if not os.path.islink(cache_symlink_path):
+            os.symlink(cache_path, cache_symlink_path)
 
     # to avoid runtime errors for missing keys when using flash()
-    alphabet = 'abcdefghijklmnopqrstuvwxyz1234567890'
-    app.secret_key = ''.join(secrets.choice(alphabet) for i in range(36))
+    if config.SECRET_KEY:
+        app.secret_key = config.SECRET_KEY
+    else:
+        alphabet = 'abcdefghijklmnopqrstuvwxyz1234567890'
+        app.secret_key = ''.join(secrets.choice(alphabet) for i in range(36))
+
+    if config.WARM_UP:
+        # heavy dependencies are imported on first use, unless warmed up here
+        threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+
+if __name__ == '__main__':
+    # Development server only, see wsgi.py for production deployments
+    setup()
 
     port = 5000
     if len(sys.argv) > 2 and sys.argv[1] == '-p':
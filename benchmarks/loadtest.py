@@ -0,0 +1,291 @@
+"""
+Load test: many virtual users going through visualization sessions at the same
+time against one visualizer instance, reporting throughput, latency percentiles
+and error rates per endpoint.
+
+    $ python benchmarks/loadtest.py [--users 10] [--duration 60] [--pages 5]
+          [--url http://localhost:5000] [--json]
+
+Each virtual user repeats a session until the duration is over: upload a MMIF
+file, wait for it to be rendered (polling /status), display it, load its tabs,
+open the OCR views and page through them, and finally decache it, which renders
+it again. Every user uploads its own copy of the file (the copies differ in
+trailing whitespace), so that users do not share or invalidate each other's
+visualizations.
+
+Unless --url is given, the app is started with Flask's threaded development
+server in a separate process on a free port, with a temporary cache directory.
+Everything runs offline: the files are examples/whisper-spacy.json and a small
+synthetic MMIF file with an OCR view and a dummy video, generated by
+benchmarks/synthetic.py. To test a production setup, start it (see wsgi.py)
+and pass its URL; the synthetic video must then be readable by the server.
+
+A request counts as an error if it fails, answers with a 4xx or 5xx status, or
+returns an error message in place of a tab or OCR page.
+"""
+import argparse
+import json
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+from collections import defaultdict
+
+import synthetic
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLES = [os.path.join(ROOT, "examples", "whisper-spacy.json")]
+ENDPOINTS = ("upload", "status", "display", "tab", "ocr", "ocr_page", "decache")
+STATUS_POLL_INTERVAL = 0.2
+RENDER_TIMEOUT = 300
+
+# run in the child process: the app on Flask's threaded development server
+_SERVER = """
+import logging
+from app import app, setup
+setup()
+logging.getLogger("werkzeug").setLevel(logging.ERROR)
+app.run(host="127.0.0.1", port={port}, threaded=True, debug=False, use_reloader=False)
+"""
+
+
+class RequestError(Exception):
+    pass
+
+
+class Recorder():
+    """
+    Latencies and errors of the requests made by all virtual users.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.error_messages = defaultdict(set)
+        self.sessions = 0
+
+    def request(self, endpoint, url, data=None, headers=None, check=None):
+        """
+        Makes a request and records its latency, returns the response body.
+        Raises RequestError if it failed.
+        """
+        request = urllib.request.Request(url, data=data, headers={"User-Agent": "curl (load test)", **(headers or {})})
+        start = time.perf_counter()
+        error = None
+        body = b""
+        try:
+            with urllib.request.urlopen(request, timeout=RENDER_TIMEOUT) as response:
+                body = response.read()
+        except urllib.error.HTTPError as e:
+            error = f"HTTP {e.code}"
+        except (urllib.error.URLError, OSError) as e:
+            error = type(e).__name__
+        latency = time.perf_counter() - start
+        if error is None and check is not None and not check(body):
+            error = "error in response"
+        with self.lock:
+            self.latencies[endpoint].append(latency)
+            if error is not None:
+                self.errors[endpoint] += 1
+                self.error_messages[endpoint].add(error)
+        if error is not None:
+            raise RequestError(f"{endpoint}: {error}")
+        return body
+
+    def report(self, elapsed):
+        endpoints = {}
+        for endpoint in ENDPOINTS:
+            latencies = sorted(self.latencies.get(endpoint, []))
+            if not latencies:
+                continue
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "throughput_rps": round(len(latencies) / elapsed, 2),
+                "error_rate": round(self.errors[endpoint] / len(latencies), 4),
+                "errors": sorted(self.error_messages[endpoint]),
+                "mean_ms": round(1000 * sum(latencies) / len(latencies), 1),
+                "p50_ms": round(1000 * percentile(latencies, 50), 1),
+                "p95_ms": round(1000 * percentile(latencies, 95), 1),
+                "p99_ms": round(1000 * percentile(latencies, 99), 1),
+                "max_ms": round(1000 * latencies[-1], 1),
+            }
+        n_requests = sum(e["requests"] for e in endpoints.values())
+        n_errors = sum(self.errors.values())
+        return {"elapsed_s": round(elapsed, 1), "sessions": self.sessions,
+                "sessions_per_s": round(self.sessions / elapsed, 3), "requests": n_requests,
+                "throughput_rps": round(n_requests / elapsed, 2),
+                "error_rate": round(n_errors / n_requests, 4) if n_requests else 0.0, "endpoints": endpoints}
+
+
+def percentile(sorted_values, p):
+    # nearest rank
+    rank = max(1, -(-len(sorted_values) * p // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def multipart(field, filename, content):
+    boundary = uuid.uuid4().hex
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: application/json\r\n\r\n").encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    return body, {"Content-Type": f"multipart/form-data; boundary={boundary}"}
+
+
+def no_error(body):
+    # tabs and OCR pages that failed are replaced by an error message
+    return not body.lstrip().startswith((b'<p class="error">', b"Error rendering"))
+
+
+def session(recorder, url, mmif_bytes, n_pages):
+    """
+    Goes through one visualization session like a browser would.
+    """
+    body, headers = multipart("file", "upload.mmif", mmif_bytes)
+    response = recorder.request("upload", f"{url}/upload", body, headers).decode()
+    viz_id = re.search(r"Visualization ID is (\w+)", response)
+    if viz_id is None:
+        raise RequestError("upload: no visualization ID in the response")
+    viz_id = viz_id.group(1)
+    wait_for_render(recorder, url, viz_id)
+
+    page = recorder.request("display", f"{url}/display/{viz_id}").decode()
+    for tab_url in re.findall(r'data-src="([^"]+)"', page):
+        try:
+            tab = recorder.request("tab", url + tab_url, check=no_error)
+        except RequestError:
+            # the other tabs still work
+            continue
+        if b"url:'/ocr'" in tab:
+            view_id = re.search(rb'"view_id": "([^"]+)"', tab)
+            if view_id is not None:
+                browse_ocr(recorder, url, viz_id, view_id.group(1).decode(), n_pages)
+
+    recorder.request("decache", f"{url}/decache?viz_id={viz_id}")
+
+
+def wait_for_render(recorder, url, viz_id):
+    deadline = time.monotonic() + RENDER_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            status = json.loads(recorder.request("status", f"{url}/status/{viz_id}"))
+        except RequestError:
+            # not known yet right after a decache
+            status = {"state": "unknown"}
+        if status["state"] == "done":
+            return
+        if status["state"] == "error":
+            raise RequestError(f"render: {status['message']}")
+        time.sleep(STATUS_POLL_INTERVAL)
+    raise RequestError("render: timed out")
+
+
+def browse_ocr(recorder, url, viz_id, view_id, n_pages):
+    headers = {"Content-Type": "application/json"}
+    data = {"view_id": view_id, "mmif_id": viz_id}
+    page = recorder.request("ocr", f"{url}/ocr", json.dumps(data).encode(), headers, check=no_error)
+    vid_path = re.search(rb'"vid_path": "([^"]*)"', page)
+    total = re.search(rb'n_pages = parseInt\("(\d+)"\)', page)
+    if vid_path is None or total is None:
+        return
+    data["vid_path"] = vid_path.group(1).decode()
+    for page_number in range(1, min(n_pages, int(total.group(1)))):
+        data["page_number"] = page_number
+        recorder.request("ocr_page", f"{url}/ocr", json.dumps(data).encode(), headers, check=no_error)
+
+
+def virtual_user(recorder, url, mmif_bytes, n_pages, deadline):
+    while time.monotonic() < deadline:
+        try:
+            session(recorder, url, mmif_bytes, n_pages)
+            with recorder.lock:
+                recorder.sessions += 1
+        except RequestError:
+            # the failed request is recorded, start over after a moment
+            time.sleep(1)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_server(cache_dir):
+    port = free_port()
+    server = subprocess.Popen([sys.executable, "-c", _SERVER.format(port=port)], cwd=ROOT,
+                              env={**os.environ, "MMIF_VIZ_CACHE_DIR": cache_dir})
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(300):
+        try:
+            urllib.request.urlopen(f"{url}/upload", timeout=1).close()
+            return server, url
+        except (urllib.error.URLError, OSError):
+            if server.poll() is not None:
+                sys.exit("The server did not start")
+            time.sleep(0.1)
+    server.terminate()
+    sys.exit("The server did not start")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10, help="number of concurrent virtual users")
+    parser.add_argument("--duration", type=float, default=60, help="seconds to run sessions for")
+    parser.add_argument("--ramp-up", type=float, default=5, help="seconds over which users start")
+    parser.add_argument("--pages", type=int, default=5, help="OCR pages to go through per view")
+    parser.add_argument("--url", help="URL of a running visualizer, instead of starting one")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="mmif-viz-loadtest-") as work_dir:
+        files = EXAMPLES + [synthetic.generate(os.path.join(work_dir, "synthetic"), n_views=3, n_annotations=40,
+                                               n_alignments=500, video_seconds=20)]
+        contents = [open(path, "rb").read() for path in files]
+        server = None
+        url = args.url.rstrip("/") if args.url else None
+        if url is None:
+            server, url = start_server(os.path.join(work_dir, "cache"))
+        recorder = Recorder()
+        start = time.monotonic()
+        deadline = start + args.duration
+        users = []
+        try:
+            for i in range(args.users):
+                content = contents[i % len(contents)] + b" " * (i + 1)
+                user = threading.Thread(target=virtual_user, args=(recorder, url, content, args.pages, deadline),
+                                        daemon=True)
+                user.start()
+                users.append(user)
+                time.sleep(args.ramp_up / args.users)
+            for user in users:
+                user.join()
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+        report = recorder.report(time.monotonic() - start)
+
+    report.update(users=args.users, url=args.url or "local development server")
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{report['users']} users, {report['sessions']} sessions in {report['elapsed_s']} s, "
+          f"{report['throughput_rps']} requests/s, error rate {report['error_rate']:.2%}")
+    print(f"{'endpoint':<10}{'requests':>10}{'req/s':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'max ms':>10}")
+    for endpoint, e in report["endpoints"].items():
+        print(f"{endpoint:<10}{e['requests']:>10}{e['throughput_rps']:>8}{e['error_rate']:>8.1%}{e['p50_ms']:>10}"
+              f"{e['p95_ms']:>10}{e['p99_ms']:>10}{e['max_ms']:>10}")
+        if e["errors"]:
+            print(f"{'':<10}{', '.join(e['errors'])}")
+
+
+if __name__ == "__main__":
+    main()
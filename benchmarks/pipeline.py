@@ -0,0 +1,251 @@
+"""
+Measures the stages of visualizing a MMIF file, from upload to the OCR pages, on
+the example files and on synthetic MMIF files of increasing size, and reports
+the wall time, peak memory and output size of each stage as JSON.
+
+    $ python benchmarks/pipeline.py [--synthetic small medium] [--no-examples]
+          [--output report.json] [MMIF_FILE ...]
+
+The stages, run in order for every input file:
+
+- upload_file: storing the uploaded file (rendering is run as the next stage
+  rather than in the background)
+- render_mmif: parsing the file and rendering the page with its tabs
+- write_vtt: writing the captions of the ASR views
+- prepare_ocr, render_ocr_page: paginating each OCR view (and decoding its
+  frames) and rendering its first page, measured per view
+- render_tabs: rendering the contents of every tab
+- cleanup: evicting all visualizations from the cache, once after all inputs
+
+The inputs are examples/whisper-spacy.json and examples/ocr-test-files/*.mmif
+(unless --no-examples is given), MMIF files given as arguments, and synthetic
+files generated with a dummy video by benchmarks/synthetic.py at the scales
+given with --synthetic. Everything is written to a temporary cache directory,
+which is linked into the static folder like the server does.
+
+Peak memory is the largest amount of memory allocated by Python during the
+stage (with tracemalloc, which slows down the stages somewhat; --no-tracemalloc
+turns it off), the maximum resident set size of the process is reported as
+well. The output size is the growth of the cache directory. A stage that fails
+is reported with its error and the remaining stages of the input still run.
+"""
+import argparse
+import contextlib
+import glob
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import synthetic  # noqa: E402
+
+EXAMPLES = [os.path.join(ROOT, "examples", "whisper-spacy.json")] + \
+    sorted(glob.glob(os.path.join(ROOT, "examples", "ocr-test-files", "*.mmif")))
+
+# views, annotations, alignments and seconds of video of the synthetic files,
+# see benchmarks/synthetic.py
+SCALES = {
+    "small": {"n_views": 3, "n_annotations": 100, "n_alignments": 1000, "video_seconds": 10},
+    "medium": {"n_views": 6, "n_annotations": 1000, "n_alignments": 10000, "video_seconds": 60},
+    "large": {"n_views": 12, "n_annotations": 5000, "n_alignments": 50000, "video_seconds": 600},
+}
+
+
+def directory_size(path):
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            with contextlib.suppress(OSError):
+                size += os.lstat(os.path.join(dirpath, filename)).st_size
+    return size
+
+
+class StageTimer():
+    """
+    Runs the stages of a benchmark and collects their measurements.
+    """
+
+    def __init__(self, cache_root, trace_memory=True):
+        self.cache_root = cache_root
+        self.trace_memory = trace_memory
+        self.stages = []
+
+    def run(self, name, fn, *args, **kwargs):
+        """
+        Runs and measures a stage, returns its result or None if it failed.
+        """
+        size_before = directory_size(self.cache_root)
+        if self.trace_memory:
+            tracemalloc.reset_peak()
+            memory_before = tracemalloc.get_traced_memory()[0]
+        result, error = None, None
+        start = time.perf_counter()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        wall = time.perf_counter() - start
+        self.stages.append({
+            "stage": name,
+            "wall_s": round(wall, 4),
+            "peak_mb": round((tracemalloc.get_traced_memory()[1] - memory_before) / 2 ** 20, 2)
+            if self.trace_memory else None,
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            "output_bytes": directory_size(self.cache_root) - size_before,
+            "error": error,
+        })
+        return result
+
+    def skip(self, name, reason):
+        self.stages.append({"stage": name, "skipped": reason})
+
+
+@contextlib.contextmanager
+def jobs_deferred(jobs):
+    """
+    Keeps upload_file() from starting the render job, which is run as a stage
+    of its own.
+    """
+    submit = jobs.submit
+    jobs.submit = lambda viz_id, render_fn, *args: None
+    try:
+        yield
+    finally:
+        jobs.submit = submit
+
+
+def benchmark_file(path, trace_memory):
+    import app
+    import cache
+    import render
+    import utils
+
+    with open(path, "rb") as f:
+        mmif_bytes = f.read()
+    timer = StageTimer(cache.get_cache_root(), trace_memory)
+    with jobs_deferred(app.jobs), app.app.test_request_context("/upload", method="POST",
+                                                               headers={"User-Agent": "curl"}):
+        response = timer.run("upload_file", app.upload_file, mmif_bytes)
+    viz_id = response.split()[3] if isinstance(response, str) else None
+    if viz_id is None:
+        return timer.stages
+
+    with app.app.app_context():
+        html_page = timer.run("render_mmif", app.render_mmif, mmif_bytes.decode("utf-8"), viz_id)
+    if html_page is None:
+        return timer.stages
+    cache.write_artifact(viz_id, "index.html", html_page, compress=True)
+    mmif = app.mmif_cache.get_mmif(viz_id)
+
+    views_by_type = {}
+    for view in mmif.views:
+        views_by_type.setdefault(utils.get_abstract_view_type(view, mmif), []).append(view)
+    if views_by_type.get("ASR"):
+        timer.run("write_vtt", utils.get_vtt_files, views_by_type["ASR"], viz_id, mmif)
+    else:
+        timer.skip("write_vtt", "no ASR views")
+
+    if views_by_type.get("OCR"):
+        from ocr import prepare_ocr
+        from mmif import DocumentTypes
+        for view in views_by_type["OCR"]:
+            timer.run("prepare_ocr", prepare_ocr, mmif, view, viz_id)
+            timer.stages[-1]["view"] = view.id
+            if timer.stages[-1]["error"]:
+                continue
+            vid_path = mmif.get_documents_by_type(DocumentTypes.VideoDocument)[0].location_path()
+            with app.app.test_request_context():
+                timer.run("render_ocr_page", render.render_ocr_page, viz_id, vid_path, view.id, 0)
+            timer.stages[-1]["view"] = view.id
+    else:
+        timer.skip("prepare_ocr", "no OCR views")
+        timer.skip("render_ocr_page", "no OCR views")
+
+    def render_tabs():
+        with app.app.test_request_context():
+            tabs = render.render_documents(mmif, viz_id) + render.render_annotations(mmif, viz_id)
+            for tab in tabs:
+                tab.render_html()
+        failed = [tab.id for tab in tabs if tab.error is not None]
+        if failed:
+            raise RuntimeError(f"tabs {', '.join(failed)} failed")
+    timer.run("render_tabs", render_tabs)
+    return timer.stages
+
+
+def benchmark_cleanup(trace_memory):
+    import cache
+    import config
+    timer = StageTimer(cache.get_cache_root(), trace_memory)
+    max_size = config.CACHE_MAX_SIZE
+    config.CACHE_MAX_SIZE = 0
+    try:
+        timer.run("cleanup", cache.cleanup)
+    finally:
+        config.CACHE_MAX_SIZE = max_size
+    return timer.stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("files", nargs="*", help="further MMIF files to measure")
+    parser.add_argument("--synthetic", nargs="*", choices=SCALES, default=["small", "medium"],
+                        help="scales of the synthetic files (default: small medium)")
+    parser.add_argument("--no-examples", action="store_true", help="skip the example files")
+    parser.add_argument("--no-tracemalloc", action="store_true", help="do not measure the peak memory of stages")
+    parser.add_argument("--output", help="write the report to this file instead of printing it")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix="mmif-viz-benchmark-")
+    # set before the visualizer reads its configuration; pages are not
+    # prefetched in the background, which would overlap with later stages
+    os.environ["MMIF_VIZ_CACHE_DIR"] = os.path.join(work_dir, "cache")
+    os.environ.setdefault("MMIF_VIZ_PREFETCH_PAGES", "0")
+    logging.getLogger().setLevel(logging.WARNING)
+    import app
+    import config
+    app.setup()
+    if not args.no_tracemalloc:
+        tracemalloc.start()
+
+    try:
+        inputs = [] if args.no_examples else list(EXAMPLES)
+        inputs += [os.path.abspath(path) for path in args.files]
+        for scale in args.synthetic:
+            inputs.append(synthetic.generate(os.path.join(work_dir, scale), **SCALES[scale]))
+        results = []
+        for path in inputs:
+            name = f"synthetic-{os.path.basename(os.path.dirname(path))}" if path.startswith(work_dir) \
+                else os.path.relpath(path, ROOT)
+            print(f"Measuring {name}", file=sys.stderr)
+            results.append({"input": name, "size_bytes": os.path.getsize(path),
+                            "stages": benchmark_file(path, not args.no_tracemalloc)})
+        results.append({"input": None, "size_bytes": None, "stages": benchmark_cleanup(not args.no_tracemalloc)})
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        "environment": {"python": platform.python_version(), "platform": platform.platform(),
+                        "decode_workers": config.DECODE_WORKERS, "preextract_frames": config.PREEXTRACT_FRAMES,
+                        "fast_load": config.FAST_LOAD,
+                        "tracemalloc": not args.no_tracemalloc, "synthetic_scales": {s: SCALES[s] for s in args.synthetic}},
+        "results": results,
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
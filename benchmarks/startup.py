@@ -0,0 +1,201 @@
+"""
+Measures the startup cost of the visualizer in fresh Python processes:
+
+- cold start: importing the app, setting it up and serving the first /display
+  request of an already rendered visualization, with and without the warm-up
+  of the heavy dependencies (MMIF_VIZ_WARM_UP), and which of them got loaded
+- renderers: importing and rendering a small named entity visualization with
+  the built-in entity renderer and with spaCy's displaCy
+
+    $ python benchmarks/startup.py [--repeat 5] [--json] [--importtime 15]
+
+Every measurement runs in a new interpreter, so nothing is cached in-process.
+The visualization is rendered once beforehand, in a temporary cache directory,
+from examples/whisper-spacy.json. Renderers whose dependencies are not installed
+are reported as skipped. With --importtime, the modules with the largest
+cumulative import time of "import app" (from python -X importtime) are listed.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SAMPLE = {"title": None,
+          "text": "The National Broadcasting Company presents the vivid drama of life itself.",
+          "ents": [{"start": 4, "end": 33, "label": "ORG"}]}
+
+# run in the child process: import, render once, report time and peak memory
+_CHILD = """
+import json, resource, sys, time
+start = time.perf_counter()
+{setup}
+imported = time.perf_counter()
+html = {render}
+rendered = time.perf_counter()
+print(json.dumps({{"import_s": imported - start, "first_render_s": rendered - imported,
+                  "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  "modules": len(sys.modules)}}))
+"""
+
+# modules that are only needed by some tabs and are imported when first used
+HEAVY_MODULES = ("mmif", "lapps", "cv2", "spacy")
+
+EXAMPLE = os.path.join("examples", "whisper-spacy.json")
+
+# run in the child process: upload the example and wait for it to be rendered
+_PREPARE = """
+import json, time
+import app
+app.setup()
+client = app.app.test_client()
+with open({example!r}, "rb") as f:
+    client.post("/upload", data={{"file": (f, "example.json")}}, headers={{"User-Agent": "curl"}})
+viz_id = {viz_id!r}
+while app.jobs.is_pending(viz_id):
+    time.sleep(0.05)
+print(json.dumps(client.get("/status/" + viz_id).get_json()))
+"""
+
+# run in the child process: start the app and serve the first page
+_COLD_START = """
+import json, resource, sys, threading, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.setup()
+set_up = time.perf_counter()
+response = app.app.test_client().get("/display/{viz_id}")
+served = time.perf_counter()
+assert response.status_code == 200, response.status_code
+# the warm-up thread, if any, is waited for to see what it loaded
+for thread in threading.enumerate():
+    if thread.name == "warm-up":
+        thread.join()
+print(json.dumps({{"import_s": imported - start, "setup_s": set_up - imported,
+                  "first_display_s": served - set_up, "total_s": served - start,
+                  "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  "heavy_modules": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+COLD_START_CASES = {
+    "lazy": {"MMIF_VIZ_WARM_UP": "0"},
+    "warm-up": {"MMIF_VIZ_WARM_UP": "1"},
+}
+
+CASES = {
+    "native": ("import displacy", "displacy.dict_to_html(sample)"),
+    "spacy": ("from spacy import displacy", "displacy.render(sample, style='ent', manual=True)"),
+}
+
+
+def run_child(code, env=None):
+    """
+    Runs code in a new interpreter and returns the JSON it printed last, or None
+    if it failed.
+    """
+    result = subprocess.run([sys.executable, "-c", code], cwd=ROOT, capture_output=True, text=True,
+                            env={**os.environ, "MMIF_VIZ_NER_RENDERER": "native", **(env or {})})
+    if result.returncode != 0:
+        return None
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def measure(setup, render):
+    return run_child(f"sample = {SAMPLE!r}\n" + _CHILD.format(setup=setup, render=render))
+
+
+def prepare_visualization(cache_dir):
+    """
+    Renders the example MMIF file into a cache directory, returns its ID.
+    """
+    import hashlib
+    with open(os.path.join(ROOT, EXAMPLE), "rb") as f:
+        viz_id = hashlib.sha1(f.read()).hexdigest()
+    status = run_child(_PREPARE.format(example=EXAMPLE, viz_id=viz_id), {"MMIF_VIZ_CACHE_DIR": cache_dir})
+    if status is None or status["state"] != "done":
+        sys.exit(f"Rendering {EXAMPLE} failed: {status}")
+    return viz_id
+
+
+def measure_cold_start(viz_id, cache_dir, env):
+    return run_child(_COLD_START.format(viz_id=viz_id, heavy=HEAVY_MODULES),
+                     {"MMIF_VIZ_CACHE_DIR": cache_dir, **env})
+
+
+def importtime(limit):
+    """
+    Returns the modules with the largest cumulative import time (in seconds)
+    when importing the app, as reported by python -X importtime.
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app"], cwd=ROOT,
+                            capture_output=True, text=True)
+    modules = []
+    for line in result.stderr.splitlines():
+        fields = line.split("|")
+        if not line.startswith("import time:") or not fields[1].strip().isdigit():
+            continue
+        modules.append((fields[2].strip(), int(fields[1]) / 1e6))
+    return sorted(modules, key=lambda m: m[1], reverse=True)[:limit]
+
+
+def median_report(runs):
+    if any(run is None for run in runs):
+        return None
+    report = {key: statistics.median(run[key] for run in runs)
+              for key, value in runs[0].items() if isinstance(value, (int, float))}
+    report.update({key: value for key, value in runs[-1].items() if not isinstance(value, (int, float))})
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="number of fresh processes per case")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--importtime", type=int, default=0, metavar="N",
+                        help="list the N modules with the largest cumulative import time")
+    args = parser.parse_args()
+
+    report = {"cold_start": {}, "renderers": {}}
+    with tempfile.TemporaryDirectory() as cache_dir:
+        viz_id = prepare_visualization(cache_dir)
+        for name, env in COLD_START_CASES.items():
+            runs = [measure_cold_start(viz_id, cache_dir, env) for _ in range(args.repeat)]
+            report["cold_start"][name] = median_report(runs)
+    for name, (setup, render) in CASES.items():
+        report["renderers"][name] = median_report([measure(setup, render) for _ in range(args.repeat)])
+    if args.importtime:
+        report["importtime"] = importtime(args.importtime)
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    print(f"{'cold start':<10}{'import (s)':>12}{'setup (s)':>12}{'display (s)':>13}{'total (s)':>12}"
+          f"{'max RSS (MB)':>14}  heavy modules loaded")
+    for name, result in report["cold_start"].items():
+        if result is None:
+            print(f"{name:<10}{'failed':>48}")
+        else:
+            print(f"{name:<10}{result['import_s']:>12.3f}{result['setup_s']:>12.3f}{result['first_display_s']:>13.3f}"
+                  f"{result['total_s']:>12.3f}{result['max_rss_mb']:>14.1f}  {', '.join(result['heavy_modules']) or '-'}")
+    print()
+    print(f"{'renderer':<10}{'import (s)':>12}{'render (s)':>12}{'max RSS (MB)':>14}{'modules':>10}")
+    for name, result in report["renderers"].items():
+        if result is None:
+            print(f"{name:<10}{'skipped (not installed)':>48}")
+        else:
+            print(f"{name:<10}{result['import_s']:>12.3f}{result['first_render_s']:>12.4f}"
+                  f"{result['max_rss_mb']:>14.1f}{result['modules']:>10.0f}")
+    if args.importtime:
+        print()
+        print(f"{'module':<50}{'cumulative (s)':>16}")
+        for module, seconds in report["importtime"]:
+            print(f"{module:<50}{seconds:>16.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,177 @@
+"""
+Generates synthetic MMIF files of a chosen size, with a dummy video (and
+transcript) written locally so that every tab, including OCR, can be rendered.
+
+    $ python benchmarks/synthetic.py OUT_DIR [--views 3] [--annotations 1000]
+          [--alignments 5000] [--video-seconds 60]
+
+The views cycle through the kinds the visualizer has tabs for: ASR (a
+transcript with one time frame and alignment per token, --alignments tokens),
+NER (--annotations named entities over the transcript) and OCR (--annotations
+time points spread over the video, each aligned to a text document and a
+bounding box). OUT_DIR gets synthetic.mmif, synthetic.mp4 and synthetic.txt.
+"""
+import argparse
+import json
+import os
+import random
+
+FPS = 30
+WIDTH, HEIGHT = 320, 240
+
+_VOCABULARY = "http://mmif.clams.ai/vocabulary"
+_LAPPS = "http://vocab.lappsgrid.org"
+_WORDS = ("the", "national", "broadcasting", "company", "presents", "vivid", "drama", "of", "life",
+          "itself", "mediation", "court", "human", "relations", "board", "decision", "story")
+_LABELS = ("PERSON", "ORG", "GPE", "DATE", "CARDINAL", "EVENT")
+
+
+def make_video(path, seconds, fps=FPS):
+    """
+    Writes a video whose frames show their own number on a background that
+    changes every second, so that neighbouring frames look alike and frames
+    far apart do not.
+    """
+    import cv2
+    import numpy as np
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"mp4v"), fps, (WIDTH, HEIGHT))
+    for frame_num in range(max(1, int(seconds * fps))):
+        second = frame_num // fps
+        frame = np.full((HEIGHT, WIDTH, 3), ((second * 37) % 256, (second * 91) % 256, (second * 53) % 256),
+                        dtype=np.uint8)
+        cv2.putText(frame, str(frame_num), (20, HEIGHT // 2), cv2.FONT_HERSHEY_SIMPLEX, 1.5,
+                    (255, 255, 255), 2)
+        writer.write(frame)
+    writer.release()
+
+
+def make_text(n_tokens, seed=0):
+    """
+    Returns a transcript of n_tokens words and the (start, end) offsets of each.
+    """
+    rng = random.Random(seed)
+    chunks, offsets, length = [], [], 0
+    for i in range(n_tokens):
+        # sentences of 12 words, paragraphs of 4 sentences
+        word = rng.choice(_WORDS) + ("." if i % 12 == 11 else "")
+        offsets.append((length, length + len(word)))
+        chunks.append(word + ("\n" if i % 48 == 47 else " "))
+        length += len(word) + 1
+    return "".join(chunks), offsets
+
+
+def make_mmif(video_path, text_path, n_views=3, n_annotations=1000, n_alignments=5000, video_seconds=60,
+              seed=0):
+    """
+    Returns a synthetic MMIF file (as a dictionary) about the video and the
+    transcript at the given paths, which are written by make_video() and
+    make_text().
+    """
+    rng = random.Random(seed)
+    text, offsets = make_text(n_alignments, seed)
+    duration_ms = video_seconds * 1000
+    documents = [
+        _annotation(f"{_VOCABULARY}/VideoDocument/v1", id="d1", mime="video/mp4", fps=FPS,
+                    location=f"file://{os.path.abspath(video_path)}"),
+        _annotation(f"{_VOCABULARY}/AudioDocument/v1", id="d2", mime="audio",
+                    location=f"file://{os.path.abspath(video_path)}"),
+        _annotation(f"{_VOCABULARY}/TextDocument/v1", id="d3", mime="text",
+                    location=f"file://{os.path.abspath(text_path)}"),
+    ]
+    kinds = (asr_view, ner_view, ocr_view)
+    views = [kinds[i % len(kinds)](f"v_{i}", text, offsets, n_annotations, duration_ms, rng)
+             for i in range(n_views)]
+    return {"metadata": {"mmif": "http://mmif.clams.ai/1.0.0"}, "documents": documents, "views": views}
+
+
+def asr_view(view_id, text, offsets, n_annotations, duration_ms, rng):
+    annotations = [_annotation(f"{_VOCABULARY}/TextDocument/v1", id="td_1", text={"@value": text}),
+                   _annotation(f"{_VOCABULARY}/Alignment/v1", id="al_0", source="d2", target="td_1")]
+    step = duration_ms / max(1, len(offsets))
+    for i, (start, end) in enumerate(offsets, 1):
+        annotations.append(_annotation(f"{_LAPPS}/Token", id=f"to_{i}", word=text[start:end], start=start,
+                                       end=end, document=f"{view_id}:td_1"))
+        annotations.append(_annotation(f"{_VOCABULARY}/TimeFrame/v1", id=f"tf_{i}", frameType="speech",
+                                       start=round((i - 1) * step), end=round(i * step)))
+        annotations.append(_annotation(f"{_VOCABULARY}/Alignment/v1", id=f"al_{i}", source=f"tf_{i}",
+                                       target=f"to_{i}"))
+    contains = {f"{_VOCABULARY}/TextDocument/v1": {}, f"{_LAPPS}/Token": {},
+                f"{_VOCABULARY}/TimeFrame/v1": {"timeUnit": "milliseconds", "document": "d2"},
+                f"{_VOCABULARY}/Alignment/v1": {}}
+    return _view(view_id, "http://apps.clams.ai/whisper-wrapper/v1.0", contains, annotations)
+
+
+def ner_view(view_id, text, offsets, n_annotations, duration_ms, rng):
+    annotations = []
+    for i, token in enumerate(sorted(rng.sample(range(len(offsets)), min(n_annotations, len(offsets)))), 1):
+        start, end = offsets[token]
+        annotations.append(_annotation(f"{_LAPPS}/NamedEntity", id=f"ne_{i}", start=start, end=end,
+                                       text=text[start:end], category=rng.choice(_LABELS)))
+    contains = {f"{_LAPPS}/NamedEntity": {"document": "d3"}}
+    return _view(view_id, "http://apps.clams.ai/spacy-wrapper/v1.0", contains, annotations)
+
+
+def ocr_view(view_id, text, offsets, n_annotations, duration_ms, rng):
+    annotations = []
+    step = duration_ms / max(1, n_annotations)
+    for i in range(1, n_annotations + 1):
+        x, y = rng.randrange(WIDTH // 2), rng.randrange(HEIGHT // 2)
+        annotations += [
+            _annotation(f"{_VOCABULARY}/TimePoint/v1", id=f"tp_{i}", timePoint=round((i - 0.5) * step),
+                        label=rng.choice(("slate", "chyron", "credits"))),
+            _annotation(f"{_VOCABULARY}/BoundingBox/v1", id=f"bb_{i}", timePoint=f"tp_{i}", boxType="text",
+                        coordinates=[[x, y], [x + 80, y + 30]]),
+            _annotation(f"{_VOCABULARY}/TextDocument/v1", id=f"td_{i}",
+                        text={"@value": " ".join(rng.choice(_WORDS) for _ in range(4))}),
+            _annotation(f"{_VOCABULARY}/Alignment/v1", id=f"al_{2 * i - 1}", source=f"tp_{i}", target=f"bb_{i}"),
+            _annotation(f"{_VOCABULARY}/Alignment/v1", id=f"al_{2 * i}", source=f"tp_{i}", target=f"td_{i}"),
+        ]
+    contains = {f"{_VOCABULARY}/TimePoint/v1": {"timeUnit": "milliseconds", "document": "d1"},
+                f"{_VOCABULARY}/BoundingBox/v1": {"document": "d1"},
+                f"{_VOCABULARY}/TextDocument/v1": {},
+                f"{_VOCABULARY}/Alignment/v1": {}}
+    return _view(view_id, "http://apps.clams.ai/doctr-wrapper/v1.0", contains, annotations)
+
+
+def _view(view_id, app, contains, annotations):
+    return {"id": view_id,
+            "metadata": {"timestamp": "2024-01-01T00:00:00", "app": app, "contains": contains},
+            "annotations": annotations}
+
+
+def _annotation(at_type, **properties):
+    return {"@type": at_type, "properties": properties}
+
+
+def generate(out_dir, n_views=3, n_annotations=1000, n_alignments=5000, video_seconds=60, seed=0):
+    """
+    Writes a synthetic MMIF file, its video and its transcript to a directory
+    and returns the path of the MMIF file.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    video_path = os.path.join(out_dir, "synthetic.mp4")
+    text_path = os.path.join(out_dir, "synthetic.txt")
+    mmif_path = os.path.join(out_dir, "synthetic.mmif")
+    make_video(video_path, video_seconds)
+    with open(text_path, "w") as f:
+        f.write(make_text(n_alignments, seed)[0])
+    with open(mmif_path, "w") as f:
+        json.dump(make_mmif(video_path, text_path, n_views, n_annotations, n_alignments, video_seconds, seed), f)
+    return mmif_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("out_dir")
+    parser.add_argument("--views", type=int, default=3, help="number of views")
+    parser.add_argument("--annotations", type=int, default=1000,
+                        help="named entities per NER view and frames per OCR view")
+    parser.add_argument("--alignments", type=int, default=5000, help="aligned tokens per ASR view")
+    parser.add_argument("--video-seconds", type=float, default=60, help="length of the video")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    print(generate(args.out_dir, args.views, args.annotations, args.alignments, args.video_seconds, args.seed))
+
+
+if __name__ == "__main__":
+    main()
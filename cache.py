@@ -1,66 +1,291 @@
+import glob
+import gzip
 import logging
 import os
 import pathlib
 import shutil
+import sqlite3
 import tempfile
 import threading
 import time
+from contextlib import closing, contextmanager, suppress
 
-lock = threading.Lock()
+try:
+    import fcntl
+except ImportError:
+    # no cross-process locking on this platform, fall back to thread locks
+    fcntl = None
+
+try:
+    import brotli
+except ImportError:
+    # brotli is optional, without it only gzip variants are written
+    brotli = None
+
+import config
+import metrics
 
 # module constants are unchanged throughout multiple "imports"
 _CACHE_DIR_SUFFIX = "mmif-viz-cache"
-_CACHE_DIR_ROOT = tempfile.TemporaryDirectory(suffix=_CACHE_DIR_SUFFIX)
+_CACHE_DIR_ROOT = pathlib.Path(config.CACHE_DIR)
+_CATALOG_FILENAME = "catalog.sqlite"
+_LOCK_DIRNAME = "locks"
+# suffixes of the precompressed variants of artifacts, by content encoding, in
+# order of preference
+COMPRESSED_SUFFIXES = {"br": ".br", "gzip": ".gz"}
+# whether this process made sure the catalog tables exist
+_catalog_ready = False
+_thread_locks = {}
+_thread_locks_guard = threading.Lock()
+_CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS visualizations (
+    viz_id TEXT PRIMARY KEY,
+    size INTEGER NOT NULL DEFAULT 0,
+    last_access REAL NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS visualizations_last_access ON visualizations (last_access);
+CREATE TABLE IF NOT EXISTS artifacts (
+    viz_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (viz_id, path)
+);
+"""
 
 
 def get_cache_root():
-    return pathlib.Path(_CACHE_DIR_ROOT.name)
+    os.makedirs(_CACHE_DIR_ROOT, exist_ok=True)
+    return _CACHE_DIR_ROOT
+
+
+@contextmanager
+def file_lock(name, blocking=True, shared=False):
+    """
+    Exclusive lock shared by all threads and worker processes using the same
+    cache root. Locks are plain files under the ``locks`` directory. Yields
+    whether the lock was acquired, which is always True when blocking. A shared
+    lock can be held by several holders at once, but not with an exclusive one.
+    """
+    if fcntl is None:
+        # thread locks are always exclusive
+        with _thread_locks_guard:
+            thread_lock = _thread_locks.setdefault(name, threading.Lock())
+        acquired = thread_lock.acquire(blocking)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                thread_lock.release()
+        return
+    lock_dir = get_cache_root() / _LOCK_DIRNAME
+    os.makedirs(lock_dir, exist_ok=True)
+    path = lock_dir / f"{name}.lock"
+    operation = fcntl.LOCK_SH if shared else fcntl.LOCK_EX
+    while True:
+        lock_file = open(path, "a")
+        try:
+            fcntl.flock(lock_file, operation if blocking else operation | fcntl.LOCK_NB)
+            acquired = True
+        except BlockingIOError:
+            acquired = False
+        if _is_current(lock_file, path):
+            break
+        # the file was removed by evict() while we waited for it, lock the
+        # one that replaced it instead
+        lock_file.close()
+    try:
+        yield acquired
+    finally:
+        if acquired:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+        lock_file.close()
+
+
+def _is_current(lock_file, path):
+    try:
+        return os.stat(path).st_ino == os.fstat(lock_file.fileno()).st_ino
+    except FileNotFoundError:
+        return False
+
+
+def _remove_lock_files(viz_id):
+    # lock names end with the visualization ID or go on with "-<more>" after
+    # it; files that are locked by someone else are left alone, and the
+    # render lock, held by the caller, is removed last
+    if fcntl is None:
+        return
+    lock_dir = get_cache_root() / _LOCK_DIRNAME
+    render_lock_path = lock_dir / f"render-{viz_id}.lock"
+    paths = [path for path in lock_dir.glob(f"*-{glob.escape(viz_id)}*.lock")
+             if path.name.endswith(f"-{viz_id}.lock") or f"-{viz_id}-" in path.name]
+    for path in paths:
+        if path == render_lock_path:
+            continue
+        with open(path, "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            if _is_current(lock_file, path):
+                os.unlink(path)
+    with suppress(FileNotFoundError):
+        os.unlink(render_lock_path)
+
+
+def render_lock(viz_id, blocking=True, shared=False):
+    """
+    Held while a visualization is being rendered or queued, so that concurrent
+    uploads of the same MMIF file do not render it twice, and so that nothing
+    deletes the directory while it is being written. Writers that
+    may run side by side, like decoders of the same thumbnail store, share it.
+    """
+    return file_lock(f"render-{viz_id}", blocking, shared)
+
+
+def write_artifact(viz_id, rel_path, content, compress=False):
+    """
+    Writes a file under the visualization directory atomically (readers see
+    either the old or the complete new file) and registers it in the catalog.
+    With compress, precompressed variants are written next to it as well.
+    """
+    path = get_cache_root() / viz_id / rel_path
+    mode = "wb" if isinstance(content, bytes) else "w"
+    with tempfile.NamedTemporaryFile(mode, dir=path.parent, prefix=f".{path.name}.", delete=False) as tf:
+        tf.write(content)
+    os.replace(tf.name, path)
+    record_artifact(viz_id, path)
+    if compress:
+        write_compressed(viz_id, rel_path)
+    return path
+
+
+def write_compressed(viz_id, rel_path):
+    """
+    Writes the gzip variant (and the brotli variant, if brotli is installed) of
+    an artifact, so that it can be served compressed without compressing it on
+    every request.
+    """
+    content = (get_cache_root() / viz_id / rel_path).read_bytes()
+    if brotli is not None:
+        write_artifact(viz_id, f"{rel_path}{COMPRESSED_SUFFIXES['br']}", brotli.compress(content))
+    write_artifact(viz_id, f"{rel_path}{COMPRESSED_SUFFIXES['gzip']}", gzip.compress(content, mtime=0))
+
+
+def get_variants(path):
+    """
+    Returns the (content encoding, path) pairs of the precompressed variants of
+    a file that exist, in order of preference.
+    """
+    variants = []
+    for encoding, suffix in COMPRESSED_SUFFIXES.items():
+        variant_path = pathlib.Path(f"{path}{suffix}")
+        if variant_path.exists():
+            variants.append((encoding, variant_path))
+    return variants
 
 
 def invalidate_cache(viz_ids=[]):
     if not viz_ids:
-        shutil.rmtree(get_cache_root())
-        os.makedirs(get_cache_root())
+        # other workers may be using the cache root, so empty it instead of
+        # removing it, keeping the lock files and the catalog in place, and
+        # like cleanup() skip the visualizations that are being rendered
+        with file_lock("cleanup"):
+            for p in get_cache_root().iterdir():
+                if p.name == _LOCK_DIRNAME or not p.is_dir() or p.is_symlink():
+                    continue
+                with render_lock(p.name, blocking=False) as acquired:
+                    if not acquired:
+                        continue
+                    evict(p.name)
     else:
         for v in viz_ids:
-            shutil.rmtree(get_cache_root() / v)
+            with render_lock(v):
+                evict(v)
+
+
+def evict(viz_id):
+    """
+    Deletes a visualization, its catalog entries and its lock files. The caller
+    must hold its render lock.
+    """
+    shutil.rmtree(get_cache_root() / viz_id, ignore_errors=True)
+    forget(viz_id)
+    _remove_lock_files(viz_id)
+
+
+# -- Catalog --
+# The catalog is a small SQLite file in the cache root that keeps track of the
+# size and last access time of every visualization, so that size checks and
+# evictions do not need to walk the cache directory.
+
+def _connect():
+    global _catalog_ready
+    conn = sqlite3.connect(get_cache_root() / _CATALOG_FILENAME, timeout=30)
+    if not _catalog_ready:
+        # once per process, the tables are never dropped
+        conn.executescript(_CATALOG_SCHEMA)
+        _catalog_ready = True
+    return conn
 
 
 def set_last_access(path):
-    with open(os.path.join(path, "last_access.txt"), "w") as f:
-        f.write(str(time.time()))
-
-
-def scan_tmp_directory():
-    oldest_accessed_dir = {"dir": None, "access_time": None}
-    total_size = sum(f.stat().st_size for f in get_cache_root().glob('**/*') if f.is_file())
-    # this will be some visualization IDs
-    for p in get_cache_root().glob('*'):
-        if not (p / 'last_access.txt').exists():
-            oldest_accessed_dir = {"dir": p, "access_time": 0}
-        elif oldest_accessed_dir["dir"] is None:
-            with open(p / 'last_access.txt') as f:
-                timestamp = f.read()
-                if timestamp == '':
-                    continue
-                oldest_accessed_dir = {"dir": p, "access_time": float(timestamp)}
-        else:
-            with open(p / 'last_access.txt') as f:
-                if float(f.read()) < oldest_accessed_dir["access_time"]:
-                    timestamp = f.read()
-                    if timestamp == '':
-                        continue
-                    oldest_accessed_dir = {"dir": p, "access_time": float(timestamp)}
-    return total_size, oldest_accessed_dir["dir"]
+    viz_id = pathlib.Path(path).name
+    with closing(_connect()) as conn, conn:
+        conn.execute("INSERT INTO visualizations (viz_id, last_access) VALUES (?, ?) "
+                     "ON CONFLICT (viz_id) DO UPDATE SET last_access = excluded.last_access",
+                     (viz_id, time.time()))
+
+
+def record_artifact(viz_id, path):
+    """
+    Registers a file written under the visualization directory (or updates its
+    size when it is re-written) and adds its size to the visualization total.
+    """
+    path = pathlib.Path(path)
+    size = path.stat().st_size
+    rel_path = str(path.relative_to(get_cache_root() / viz_id))
+    with closing(_connect()) as conn, conn:
+        conn.execute("INSERT OR IGNORE INTO visualizations (viz_id, last_access) VALUES (?, ?)",
+                     (viz_id, time.time()))
+        row = conn.execute("SELECT size FROM artifacts WHERE viz_id = ? AND path = ?",
+                           (viz_id, rel_path)).fetchone()
+        old_size = row[0] if row else 0
+        conn.execute("INSERT OR REPLACE INTO artifacts (viz_id, path, size) VALUES (?, ?, ?)",
+                     (viz_id, rel_path, size))
+        conn.execute("UPDATE visualizations SET size = size + ? WHERE viz_id = ?",
+                     (size - old_size, viz_id))
+
+
+def forget(viz_id):
+    with closing(_connect()) as conn, conn:
+        conn.execute("DELETE FROM artifacts WHERE viz_id = ?", (viz_id,))
+        conn.execute("DELETE FROM visualizations WHERE viz_id = ?", (viz_id,))
+
+
+def get_cache_size():
+    with closing(_connect()) as conn:
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM visualizations").fetchone()[0]
+
+
+def get_least_recently_accessed():
+    """
+    Returns the visualization IDs in order of last access, oldest first.
+    """
+    with closing(_connect()) as conn:
+        return [row[0] for row in conn.execute("SELECT viz_id FROM visualizations ORDER BY last_access")]
 
 
 def cleanup():
-    with lock:
+    with file_lock("cleanup"), metrics.span("cleanup"):
         logging.info("Checking visualization cache...")
-        # Max tmp size is 500MB
-        max_size = 500000000
-        folder_size, oldest_dir = scan_tmp_directory()
-        while folder_size > max_size:
-            logging.info(f"Maximum cache size reached. Deleting {os.path.basename(oldest_dir)}.")
-            shutil.rmtree(oldest_dir)
-            folder_size, oldest_dir = scan_tmp_directory()
+        folder_size = get_cache_size()
+        for viz_id in get_least_recently_accessed():
+            if folder_size <= config.CACHE_MAX_SIZE:
+                break
+            with render_lock(viz_id, blocking=False) as acquired:
+                # never evict a visualization that is being rendered
+                if not acquired:
+                    continue
+                logging.info(f"Maximum cache size reached. Deleting {viz_id}.")
+                evict(viz_id)
+            folder_size = get_cache_size()
@@ -0,0 +1,62 @@
+"""
+Server settings. These are read from environment variables so that every worker
+process of a deployment sees the same values.
+"""
+import os
+import tempfile
+
+# Directory holding rendered visualizations. It is shared by all worker processes
+# and persists across restarts.
+CACHE_DIR = os.environ.get("MMIF_VIZ_CACHE_DIR", os.path.join(tempfile.gettempdir(), "mmif-viz-cache"))
+# Maximum size of the cache directory in bytes (default 500MB)
+CACHE_MAX_SIZE = int(os.environ.get("MMIF_VIZ_CACHE_MAX_SIZE", 500000000))
+# Flask session key; must be the same for all workers behind one port
+SECRET_KEY = os.environ.get("MMIF_VIZ_SECRET_KEY")
+# Width in pixels of the video frame thumbnails shown in OCR views
+THUMBNAIL_WIDTH = int(os.environ.get("MMIF_VIZ_THUMBNAIL_WIDTH", 640))
+# When extracting video frames, gaps of more than this many frames between two
+# requested frames are skipped by seeking, shorter ones by decoding forward
+SEEK_THRESHOLD = int(os.environ.get("MMIF_VIZ_SEEK_THRESHOLD", 250))
+# Number of OCR pages on each side of the current one whose frames are decoded
+# in the background, and the number of threads doing so (0 disables prefetching)
+PREFETCH_PAGES = int(os.environ.get("MMIF_VIZ_PREFETCH_PAGES", 1))
+PREFETCH_WORKERS = int(os.environ.get("MMIF_VIZ_PREFETCH_WORKERS", 2))
+# Number of worker processes decoding video frames and comparing images; with
+# fewer than 2 this work is done serially on the request thread
+DECODE_WORKERS = int(os.environ.get("MMIF_VIZ_DECODE_WORKERS", 1))
+# Decode all frames of an OCR view when it is first opened (rather than page by
+# page) and check the duplicate frames against each other up front
+PREEXTRACT_FRAMES = os.environ.get("MMIF_VIZ_PREEXTRACT_FRAMES", "0") == "1"
+# Estimated memory in bytes that parsed MMIF files kept in memory may take up
+MMIF_CACHE_SIZE = int(os.environ.get("MMIF_VIZ_MMIF_CACHE_SIZE", 1000000000))
+# Number of threads per worker process rendering uploaded files
+RENDER_WORKERS = int(os.environ.get("MMIF_VIZ_RENDER_WORKERS", 2))
+# Caption cues end after this many tokens (0 for no limit), when they would get
+# longer than the maximum duration in seconds, or at pauses between tokens of at
+# least the maximum pause in seconds (0 disables the duration and pause checks)
+VTT_CUE_TOKENS = int(os.environ.get("MMIF_VIZ_VTT_CUE_TOKENS", 9))
+VTT_CUE_MAX_DURATION = float(os.environ.get("MMIF_VIZ_VTT_CUE_MAX_DURATION", 0))
+VTT_CUE_MAX_PAUSE = float(os.environ.get("MMIF_VIZ_VTT_CUE_MAX_PAUSE", 0))
+# Number of characters of text shown at a time in named entity views
+NER_WINDOW_SIZE = int(os.environ.get("MMIF_VIZ_NER_WINDOW_SIZE", 20000))
+# Renderer of named entities: "native" (built in) or "spacy" (spaCy's displaCy,
+# if spaCy is installed)
+NER_RENDERER = os.environ.get("MMIF_VIZ_NER_RENDERER", "native")
+# Import the heavy rendering dependencies (MMIF SDK, OpenCV) in the background
+# on startup, instead of when the first request needs them
+WARM_UP = os.environ.get("MMIF_VIZ_WARM_UP", "0") == "1"
+# Add a Server-Timing header to responses, breaking down where the time of the
+# request went (parsing, rendering tabs, decoding frames...), see metrics.py
+SERVER_TIMING = os.environ.get("MMIF_VIZ_SERVER_TIMING", "0") == "1"
+# Above these estimated costs (0 for no limit), the tabs of a view are rendered
+# in a reduced mode, see costs.py: the annotations table with counts by type,
+# the tree grouped by type and left out of searches, the captions tab with only
+# the first cues, and the frames of OCR views decoded page by page
+TABLE_MAX_ANNOTATIONS = int(os.environ.get("MMIF_VIZ_TABLE_MAX_ANNOTATIONS", 100000))
+TREE_MAX_ANNOTATIONS = int(os.environ.get("MMIF_VIZ_TREE_MAX_ANNOTATIONS", 100000))
+VTT_MAX_ALIGNMENTS = int(os.environ.get("MMIF_VIZ_VTT_MAX_ALIGNMENTS", 20000))
+OCR_PREEXTRACT_MAX_FRAMES = int(os.environ.get("MMIF_VIZ_OCR_PREEXTRACT_MAX_FRAMES", 2000))
+# Trust uploaded MMIF files: parse them without validating them against the
+# MMIF schema (and with orjson, if it is installed), and validate them in the
+# background instead, showing a warning on the page if they are not valid
+FAST_LOAD = os.environ.get("MMIF_VIZ_FAST_LOAD", "0") == "1"
@@ -0,0 +1,120 @@
+import json
+import os
+
+import cache
+import config
+from annotation_store import get_view_store
+from utils import get_abstract_view_type
+
+"""
+Cost estimates of the tabs of a visualization, made from the columnar store
+before anything is rendered, and the mode every tab is rendered in. A tab whose
+estimated cost for a view is above its configured limit is rendered in a
+reduced mode for that view:
+
+- annotations table: "summary", counts by type, rows indexed only when asked for
+- tree: "on demand", annotations grouped by type and left out of searches
+- captions: "summary", the first cues and a link to the whole file
+- OCR: "on demand", frames decoded page by page rather than all up front
+
+The plan is written to the visualization directory the first time it is needed,
+so that the tabs and the requests they make agree on it.
+"""
+
+FULL = "full"
+SUMMARY = "summary"
+ON_DEMAND = "on demand"
+
+_PLAN_FILENAME = "plan.json"
+
+# tab -> (name shown, unit of the cost, mode above the limit, description of each mode)
+TABS = {
+    "table": ("Annotations", "annotations", SUMMARY,
+              {FULL: "all rows indexed when the tab is opened",
+               SUMMARY: "counts by type, rows indexed when asked for"}),
+    "tree": ("Tree", "annotations", ON_DEMAND,
+             {FULL: "annotations in chunks, searchable",
+              ON_DEMAND: "annotations grouped by type, not searched"}),
+    "vtt": ("Captions", "aligned tokens", SUMMARY,
+            {FULL: "all captions",
+             SUMMARY: "first captions, with a link to the whole file"}),
+    "ocr": ("OCR", "frames", ON_DEMAND,
+            {FULL: "all frames decoded when the view is opened",
+             ON_DEMAND: "frames decoded page by page"}),
+}
+
+
+def get_limits():
+    return {"table": config.TABLE_MAX_ANNOTATIONS, "tree": config.TREE_MAX_ANNOTATIONS,
+            "vtt": config.VTT_MAX_ALIGNMENTS, "ocr": config.OCR_PREEXTRACT_MAX_FRAMES}
+
+
+def get_plan(mmif, viz_id):
+    """
+    Returns the rendering plan of a visualization, estimating it first if it
+    does not have one yet.
+    """
+    path = cache.get_cache_root() / viz_id / _PLAN_FILENAME
+    if not os.path.exists(path):
+        with cache.file_lock(f"plan-{viz_id}"):
+            if not os.path.exists(path):
+                plan = estimate(mmif, viz_id)
+                cache.write_artifact(viz_id, _PLAN_FILENAME, json.dumps(plan.entries))
+                return plan
+    with open(path) as f:
+        return Plan(json.load(f))
+
+
+def estimate(mmif, viz_id):
+    """
+    Estimates the cost of every tab of every view and picks their modes.
+    """
+    limits = get_limits()
+    entries = []
+    for view in mmif.views:
+        store = get_view_store(viz_id, view.id)
+        counts = store.count_types()
+        entries.append(_entry("table", view.id, len(store), limits))
+        entries.append(_entry("tree", view.id, len(store), limits))
+        abstract_view_type = get_abstract_view_type(view, mmif)
+        if abstract_view_type == "ASR":
+            entries.append(_entry("vtt", view.id, counts.get("Alignment", 0), limits))
+        elif abstract_view_type == "OCR" and config.PREEXTRACT_FRAMES:
+            # one frame per time point or frame, views of other OCR tools only
+            # have boxes carrying their time points
+            n_frames = counts.get("TimePoint", 0) + counts.get("TimeFrame", 0) or counts.get("BoundingBox", 0)
+            entries.append(_entry("ocr", view.id, n_frames, limits))
+    return Plan(entries)
+
+
+def _entry(tab, view_id, cost, limits):
+    limit = limits[tab]
+    mode = TABS[tab][2] if limit and cost > limit else FULL
+    return {"tab": tab, "view": view_id, "cost": cost, "limit": limit, "mode": mode}
+
+
+class Plan():
+
+    def __init__(self, entries):
+        self.entries = entries
+        self._modes = {(entry["tab"], entry["view"]): entry["mode"] for entry in entries}
+
+    def mode(self, tab, view_id):
+        """
+        Returns the mode of a tab for a view, FULL if the tab was not planned.
+        """
+        return self._modes.get((tab, view_id), FULL)
+
+    def describe(self):
+        """
+        Returns one line per tab and view saying which mode it is rendered in
+        and why, for the Info tab.
+        """
+        lines = []
+        for entry in self.entries:
+            name, unit, _, descriptions = TABS[entry["tab"]]
+            limit = entry["limit"] or "no limit"
+            lines.append("%-12s %-10s %8d %s (limit %s)  %s: %s" %
+                         (name, entry["view"], entry["cost"], unit, limit, entry["mode"],
+                          descriptions[entry["mode"]]))
+        return lines
@@ -0,0 +1,75 @@
+"""
+Entity highlighting in the markup and styling of spaCy's displaCy "ent" style
+(spaCy 2.x), without importing spaCy. Takes the dictionaries that
+displacy.render(..., style='ent', manual=True) takes: the text, the entities
+with start and end offsets and labels sorted by offset, and an optional title.
+"""
+
+TPL_ENTS = """
+<div class="entities" style="line-height: 2.5; direction: {dir}">{content}</div>
+"""
+
+TPL_ENT = """
+<mark class="entity" style="background: {bg}; padding: 0.45em 0.6em; margin: 0 0.25em; line-height: 1; border-radius: 0.35em;">
+    {text}
+    <span style="font-size: 0.8em; font-weight: bold; line-height: 1; border-radius: 0.35em; text-transform: uppercase; vertical-align: middle; margin-left: 0.5rem">{label}</span>
+</mark>
+"""
+
+TPL_TITLE = """
+<h2 style="margin: 0">{title}</h2>
+"""
+
+# displaCy's colors for the labels of spaCy's English models
+COLORS = {
+    "ORG": "#7aecec",
+    "PRODUCT": "#bfeeb7",
+    "GPE": "#feca74",
+    "LOC": "#ff9561",
+    "PERSON": "#aa9cfc",
+    "NORP": "#c887fb",
+    "FAC": "#9cc9cc",
+    "FACILITY": "#9cc9cc",
+    "EVENT": "#ffeb80",
+    "LAW": "#ff8197",
+    "LANGUAGE": "#ff8197",
+    "WORK_OF_ART": "#f0d0ff",
+    "DATE": "#bfe1d9",
+    "TIME": "#bfe1d9",
+    "MONEY": "#e4e7d2",
+    "QUANTITY": "#e4e7d2",
+    "ORDINAL": "#e4e7d2",
+    "CARDINAL": "#e4e7d2",
+    "PERCENT": "#e4e7d2",
+}
+DEFAULT_COLOR = "#ddd"
+
+
+def render_ents(d, colors=None):
+    """
+    Returns the HTML of a text with its entities highlighted.
+    """
+    colors = COLORS if colors is None else {**COLORS, **colors}
+    text = d["text"]
+    markup = []
+    offset = 0
+    for ent in d["ents"]:
+        start, end, label = ent["start"], ent["end"], ent["label"]
+        markup.append(_escape_lines(text[offset:start]))
+        markup.append(TPL_ENT.format(label=label, text=escape_html(text[start:end]),
+                                     bg=colors.get(str(label).upper(), DEFAULT_COLOR)))
+        offset = end
+    markup.append(_escape_lines(text[offset:]))
+    rendered = TPL_ENTS.format(content="".join(markup), dir="ltr")
+    if d.get("title"):
+        rendered = TPL_TITLE.format(title=d["title"]) + rendered
+    return rendered
+
+
+def escape_html(text):
+    return text.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+
+def _escape_lines(text):
+    # line breaks between entities are kept as in displaCy
+    return "</br>".join(escape_html(line) for line in text.split("\n"))
@@ -0,0 +1,206 @@
+import bisect
+import codecs
+import functools
+import json
+import mmap
+import os
+import pathlib
+import re
+
+import cache
+import config
+from mmif_index import get_index
+
+"""
+Renders named entities of long texts a window at a time. The text document is
+memory-mapped rather than read, and a small index is written to the
+visualization directory the first time a view is shown: the entities sorted by
+offset, and the byte offset of every CHECKPOINT_CHARS-th character, so that any
+window of characters can be decoded without reading the text before it.
+"""
+
+INDEX_DIRNAME = "ner"
+# distance in characters between two entries of the character to byte index
+CHECKPOINT_CHARS = 4096
+# how far past the nominal end of a window a line break is looked for
+_SNAP_CHARS = 2000
+_READ_BLOCK_SIZE = 1 << 20
+
+
+def get_index_path(viz_id, view_id):
+    return cache.get_cache_root() / viz_id / _index_filename(view_id)
+
+
+def _index_filename(view_id):
+    return pathlib.Path(INDEX_DIRNAME) / f"{view_id.replace(':', '-')}.json"
+
+
+def get_text_location(textdoc):
+    """
+    Returns the path of the file of a text document, or None if the text is
+    in the MMIF file.
+    """
+    if not textdoc.location:
+        return None
+    location = textdoc.location
+    # adjust the path (possibly needed when you do not run this in a
+    # container, see the comment in html_text() in ../app.py)
+    if not os.path.isfile(location):
+        if location.startswith('file:///'):
+            location = location[7:]
+        else:
+            # this should not happen anymore, but keeping it anyway
+            location = location[1:]
+    return location
+
+
+def build_ner_index(mmif, view, document_id, viz_id):
+    """
+    Writes the window index of an NER view, unless it exists.
+    """
+    index_path = get_index_path(viz_id, view.id)
+    if os.path.exists(index_path):
+        return
+    textdoc = get_index(mmif).get(view.id, document_id)
+    location = get_text_location(textdoc)
+    if location is None:
+        text = textdoc.properties.text.value
+        length, checkpoints = len(text), []
+    else:
+        text = None
+        length, checkpoints = index_characters(location)
+    entities = []
+    for ann in get_index(mmif).get_annotations("NamedEntity", view.id):
+        span = get_span(ann, view.id, get_index(mmif))
+        if span is not None:
+            entities.append([span[0], span[1], ann.get('category')])
+    entities.sort(key=lambda e: (e[0], e[1]))
+    ner_index = {"location": location, "text": text, "length": length,
+                 "checkpoints": checkpoints, "entities": entities}
+    os.makedirs(index_path.parent, exist_ok=True)
+    cache.write_artifact(viz_id, _index_filename(view.id), json.dumps(ner_index))
+
+
+def get_span(annotation, view_id, index):
+    """
+    Returns the start and end offset of an entity, which are either properties
+    of the entity or those of the first and last of the tokens it targets.
+    """
+    if "start" in annotation.properties and "end" in annotation.properties:
+        return annotation.properties["start"], annotation.properties["end"]
+    targets = [index.get(view_id, target) for target in annotation.properties.get("targets") or []]
+    targets = [target for target in targets if target is not None and "start" in target.properties]
+    if targets:
+        return targets[0].properties["start"], targets[-1].properties["end"]
+    return None
+
+
+def index_characters(location):
+    """
+    Returns the number of characters of a UTF-8 text file and the byte offsets
+    of every CHECKPOINT_CHARS-th character, reading the file in blocks. Line
+    breaks are counted the way a file opened in text mode reads them, a CRLF
+    being one character, which is what the offsets of the entities refer to.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    checkpoints = [0]
+    n_chars = 0
+    n_bytes = 0
+    pending = ""
+    with open(location, "rb") as f:
+        while True:
+            block = f.read(_READ_BLOCK_SIZE)
+            chars = pending + decoder.decode(block, final=not block)
+            # a "\r" at the end of a block may be the start of a "\r\n"
+            pending = chars[-1:] if block and chars.endswith("\r") else ""
+            chars = chars[:len(chars) - len(pending)]
+            # the "\n" of every "\r\n" is not counted, the characters of this
+            # block up to the next checkpoint are encoded again to find its
+            # byte offset
+            dropped = [m.start() + 1 - k for k, m in enumerate(re.finditer("\r\n", chars))]
+            n_block_chars = len(chars) - len(dropped)
+            position = len(checkpoints) * CHECKPOINT_CHARS - n_chars
+            last = 0
+            block_bytes = n_bytes
+            while position < n_block_chars:
+                raw_position = position + bisect.bisect_right(dropped, position)
+                block_bytes += len(chars[last:raw_position].encode("utf-8"))
+                checkpoints.append(block_bytes)
+                last = raw_position
+                position += CHECKPOINT_CHARS
+            n_chars += n_block_chars
+            n_bytes += len(chars.encode("utf-8"))
+            if not block:
+                break
+    return n_chars, checkpoints
+
+
+def load_ner_index(viz_id, view_id):
+    path = get_index_path(viz_id, view_id)
+    return _load_ner_index(str(path), os.stat(path).st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=16)
+def _load_ner_index(path, mtime_ns):
+    # keyed by modification time, so that a re-rendered view is read again
+    with open(path) as f:
+        ner_index = json.load(f)
+    ner_index["starts"] = [e[0] for e in ner_index["entities"]]
+    return ner_index
+
+
+def read_chars(ner_index, start, end):
+    """
+    Returns the characters from start to end of the text of an NER view.
+    """
+    if ner_index["text"] is not None:
+        return ner_index["text"][start:end]
+    if start >= end:
+        return ""
+    checkpoints = ner_index["checkpoints"]
+    first = start // CHECKPOINT_CHARS
+    last = -(-end // CHECKPOINT_CHARS)
+    with open(ner_index["location"], "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as text:
+            byte_end = checkpoints[last] if last < len(checkpoints) else len(text)
+            chars = text[checkpoints[first]:byte_end].decode("utf-8", errors="replace")
+    # checkpoints never fall inside a "\r\n", see index_characters()
+    chars = chars.replace("\r\n", "\n").replace("\r", "\n")
+    offset = first * CHECKPOINT_CHARS
+    return chars[start - offset:end - offset]
+
+
+def get_window(ner_index, start, size=None):
+    """
+    Returns the text of the window starting at a character offset, the entities
+    in it (with offsets relative to the window) and where the next window
+    starts, or None at the end of the text. Windows end at a line break, or a
+    sentence end, near their nominal size and never in the middle of an entity.
+    """
+    size = size or config.NER_WINDOW_SIZE
+    length = ner_index["length"]
+    start = max(0, min(start, length))
+    end = min(start + size, length)
+    if end < length:
+        tail = read_chars(ner_index, end, min(end + _SNAP_CHARS, length))
+        snap = tail.find("\n")
+        if snap < 0:
+            snap = tail.find(". ")
+            snap = snap + 1 if snap >= 0 else -1
+        if snap >= 0:
+            end += snap + 1
+    entities = ner_index["entities"]
+    starts = ner_index["starts"]
+    first = bisect.bisect_left(starts, start)
+    last = first
+    # extend the window over entities crossing its end, which may in turn
+    # overlap with further entities
+    while last < len(entities) and starts[last] < end:
+        end = max(end, min(entities[last][1], length))
+        last += 1
+    text = read_chars(ner_index, start, end)
+    window_entities = [{"start": s - start, "end": e - start, "label": label}
+                       for s, e, label in entities[first:last]]
+    return text, window_entities, (end if end < length else None)
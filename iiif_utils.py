@@ -118,6 +118,8 @@ def save_manifest(iiif_json: Dict, viz_id) -> str:
     manifest = tempfile.NamedTemporaryFile(
         'w', dir=str(cache.get_cache_root() / viz_id), suffix='.json', delete=False)
     json.dump(iiif_json, manifest, indent=4)
+    manifest.close()
+    cache.record_artifact(viz_id, manifest.name)
     return manifest.name
 
 
@@ -0,0 +1,105 @@
+import json
+import logging
+import os
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import config
+
+"""
+Background rendering of uploaded MMIF files. The state of each render job is
+kept in a status file in the visualization directory, so that any worker
+process can report it.
+"""
+
+STATUS_FILENAME = "status.json"
+PENDING_STATES = ("queued", "rendering")
+
+_pool = ThreadPoolExecutor(max_workers=config.RENDER_WORKERS, thread_name_prefix="render")
+# number of jobs submitted by this process that are queued or running
+_pending = 0
+_pending_lock = threading.Lock()
+
+
+def submit(viz_id, render_fn, *args):
+    """
+    Queues a render job. ``render_fn`` is called with the visualization ID, a
+    progress callback taking the number of finished and total steps, and the
+    remaining arguments.
+    """
+    global _pending
+    write_status(viz_id, "queued")
+    with _pending_lock:
+        _pending += 1
+    _pool.submit(_run, viz_id, render_fn, *args)
+
+
+def _run(viz_id, render_fn, *args):
+    global _pending
+
+    done, total = 0, 0
+
+    def progress(n_done, n_total):
+        nonlocal done, total
+        done, total = n_done, n_total
+        write_status(viz_id, "rendering", done, total)
+    try:
+        render_fn(viz_id, progress, *args)
+        write_status(viz_id, "done", done, total)
+    except Exception as e:
+        logging.error(f"Rendering {viz_id} failed: {e}\n{traceback.format_exc()}")
+        write_status(viz_id, "error", done, total, message=str(e))
+    finally:
+        with _pending_lock:
+            _pending -= 1
+
+
+def get_queue_depth():
+    """
+    Returns the number of render jobs of this process that are queued or running.
+    """
+    return _pending
+
+
+def write_status(viz_id, state, done=0, total=0, message=None):
+    """
+    Writes the status file of a visualization, unless the visualization was
+    evicted in the meantime and there is nobody left to report it to.
+    """
+    status = {"state": state, "done": done, "total": total, "message": message, "pid": os.getpid()}
+    try:
+        cache.write_artifact(viz_id, STATUS_FILENAME, json.dumps(status))
+    except FileNotFoundError:
+        logging.debug(f"Not writing status {state} of {viz_id}, it was evicted")
+
+
+def get_status(viz_id):
+    """
+    Returns the status of the render job of a visualization, or None if there
+    is none. Jobs of worker processes that have died are reported as failed.
+    """
+    try:
+        with open(cache.get_cache_root() / viz_id / STATUS_FILENAME) as f:
+            status = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if status["state"] in PENDING_STATES and not _is_alive(status["pid"]):
+        status.update(state="error", message="Rendering was interrupted, please upload the file again.")
+    return status
+
+
+def is_pending(viz_id):
+    status = get_status(viz_id)
+    return status is not None and status["state"] in PENDING_STATES
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
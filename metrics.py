@@ -0,0 +1,195 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+"""
+Timing and cache metrics, exposed in the Prometheus text format at /metrics.
+
+Stages of rendering (parsing the MMIF file, rendering each tab, writing
+captions, decoding video frames, evicting from the cache...) are timed with
+span(), which records the time in a histogram and, during a request, in the
+breakdown of that request, see app.record_request(). The metrics are kept per
+process, so with several worker processes every worker reports its own.
+"""
+
+# upper bounds in seconds of the histogram buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_registry = []
+
+
+class Metric():
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {self.labelnames}, not {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def collect(self):
+        """
+        Returns the lines of the metric in the Prometheus text format.
+        """
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"] + \
+            self._samples()
+
+    def _labels(self, key, **extra):
+        pairs = list(zip(self.labelnames, key)) + list(extra.items())
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        super().__init__(name, documentation, labelnames)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def _samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{self._labels(key)} {value}" for key, value in values]
+
+
+class Gauge(Metric):
+    """
+    A value that is read when the metrics are collected, from a function.
+    """
+    type_name = "gauge"
+
+    def __init__(self, name, documentation, function):
+        super().__init__(name, documentation)
+        self.function = function
+
+    def _samples(self):
+        return [f"{self.name} {self.function()}"]
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # label values -> (count per bucket, the last one for +Inf, and sum)
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            else:
+                counts[-1] += 1
+            self._values[key] = (counts, total + value)
+
+    def _samples(self):
+        with self._lock:
+            values = sorted((key, (list(counts), total)) for key, (counts, total) in self._values.items())
+        samples = []
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                samples.append(f"{self.name}_bucket{self._labels(key, le=bound)} {cumulative}")
+            samples.append(f"{self.name}_sum{self._labels(key)} {total}")
+            samples.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return samples
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUEST_SECONDS = Histogram("mmif_viz_request_seconds", "Time to answer requests, by endpoint and status",
+                            ("endpoint", "status"))
+STAGE_SECONDS = Histogram("mmif_viz_stage_seconds", "Time spent in stages of rendering and serving",
+                          ("stage",))
+TAB_RENDER_SECONDS = Histogram("mmif_viz_tab_render_seconds", "Time to render the contents of a tab, by tab class",
+                               ("tab",))
+CACHE_LOOKUPS = Counter("mmif_viz_cache_lookups_total",
+                        "Lookups of rendered pages, tabs, parsed MMIF files and video frames, by result",
+                        ("cache", "result"))
+
+
+def collect():
+    """
+    Returns all metrics in the Prometheus text format.
+    """
+    return "\n".join(line for metric in _registry for line in metric.collect()) + "\n"
+
+
+def count_lookup(cache_name, hit, amount=1):
+    if amount:
+        CACHE_LOOKUPS.inc(amount, cache=cache_name, result="hit" if hit else "miss")
+
+
+@contextmanager
+def span(stage):
+    """
+    Times a stage, see the module docstring.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        STAGE_SECONDS.observe(elapsed, stage=stage)
+        _add_to_breakdown(stage, elapsed)
+
+
+@contextmanager
+def tab_span(tab):
+    """
+    Times the rendering of a tab, by the name of its class.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        name = type(tab).__name__
+        TAB_RENDER_SECONDS.observe(elapsed, tab=name)
+        _add_to_breakdown(f"render_tab.{name}", elapsed)
+
+
+def _add_to_breakdown(name, elapsed):
+    if has_request_context():
+        breakdown = g.setdefault("timing_breakdown", {})
+        breakdown[name] = breakdown.get(name, 0) + elapsed
+
+
+def get_breakdown():
+    """
+    Returns the time spent in each stage during the current request, in seconds
+    by stage in the order they first ended. Time in spans nested in others counts
+    towards both.
+    """
+    return g.get("timing_breakdown", {}) if has_request_context() else {}
+
+
+def server_timing(breakdown, total):
+    """
+    Returns the value of a Server-Timing header for a request breakdown.
+    """
+    entries = [f"{name};dur={1000 * elapsed:.1f}" for name, elapsed in breakdown.items()]
+    return ", ".join(entries + [f"total;dur={1000 * total:.1f}"])
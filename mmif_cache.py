@@ -0,0 +1,97 @@
+import json
+import threading
+from collections import OrderedDict
+
+try:
+    import orjson
+except ImportError:
+    # orjson is optional, without it fast loading parses with the json module
+    orjson = None
+
+import cache
+import config
+import metrics
+from mmif_index import get_index
+
+"""
+In-memory LRU cache of parsed Mmif objects and their indexes, by visualization
+ID, so that repeated requests about a visualization (like opening its OCR tabs)
+skip reading, decoding and validating the MMIF file. With config.FAST_LOAD, files
+are parsed without schema validation, which is done in the background instead,
+see validation.py.
+"""
+
+# rough ratio of the memory taken by a parsed Mmif object and its index to the
+# size of its JSON serialization, an estimate that is not measured; the total is
+# exposed as a gauge, see app.py
+_MEMORY_FACTOR = 10
+
+# viz_id -> (Mmif object, estimated size in bytes), least recently used first
+_entries = OrderedDict()
+_size = 0
+_lock = threading.Lock()
+
+
+def get_mmif(viz_id, mmif_str=None):
+    """
+    Returns the parsed MMIF file of a visualization. The MMIF string is read
+    from the visualization directory unless it is given.
+    """
+    with _lock:
+        if viz_id in _entries:
+            _entries.move_to_end(viz_id)
+            metrics.count_lookup("mmif", hit=True)
+            return _entries[viz_id][0]
+    metrics.count_lookup("mmif", hit=False)
+    if mmif_str is None:
+        with open(cache.get_cache_root() / viz_id / "file.mmif") as f:
+            mmif_str = f.read()
+    from mmif.serialize import Mmif
+    with metrics.span("parse_mmif"):
+        if config.FAST_LOAD:
+            mmif = Mmif(load_json(mmif_str), validate=False)
+        else:
+            mmif = Mmif(mmif_str)
+        get_index(mmif)
+    _put(viz_id, mmif, len(mmif_str) * _MEMORY_FACTOR)
+    return mmif
+
+
+def load_json(mmif_str):
+    """
+    Parses a MMIF string into a dictionary, with orjson if it is installed.
+    """
+    return orjson.loads(mmif_str) if orjson is not None else json.loads(mmif_str)
+
+
+def _put(viz_id, mmif, size):
+    global _size
+    if size > config.MMIF_CACHE_SIZE:
+        return
+    with _lock:
+        if viz_id in _entries:
+            _size -= _entries.pop(viz_id)[1]
+        _entries[viz_id] = (mmif, size)
+        _size += size
+        while _size > config.MMIF_CACHE_SIZE:
+            _, (_, evicted_size) = _entries.popitem(last=False)
+            _size -= evicted_size
+
+
+def discard(viz_ids=None):
+    """
+    Drops the given visualizations from memory, or all of them.
+    """
+    global _size
+    with _lock:
+        for viz_id in list(_entries) if viz_ids is None else viz_ids:
+            if viz_id in _entries:
+                _size -= _entries.pop(viz_id)[1]
+
+
+def get_memory_usage():
+    """
+    Returns the number of cached MMIF files and their estimated size in bytes.
+    """
+    with _lock:
+        return len(_entries), _size
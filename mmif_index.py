@@ -0,0 +1,104 @@
+import weakref
+from collections import defaultdict
+
+"""
+Index over all annotations of a parsed MMIF object, built in one pass and
+shared by everything that needs to look up annotations by ID, by type or by
+alignment (OCR frames, VTT captions, named entities).
+"""
+
+# id() of a Mmif object -> its index, entries are dropped with the Mmif object
+_indexes = {}
+
+
+def get_index(mmif):
+    """
+    Returns the index of a Mmif object, building it the first time it is needed.
+    """
+    key = id(mmif)
+    if key not in _indexes:
+        _indexes[key] = MmifIndex(mmif)
+        weakref.finalize(mmif, _indexes.pop, key, None)
+    return _indexes[key]
+
+
+class MmifIndex():
+    """
+    Annotations (and documents) are identified by long IDs: the view ID and the
+    annotation ID joined by a colon, or just the ID for top-level documents.
+    """
+
+    def __init__(self, mmif):
+        # long id -> annotation
+        self.annotations = {}
+        # type shortname -> long ids, in document order
+        self.by_type = defaultdict(list)
+        # view id -> long ids, in document order
+        self.by_view = defaultdict(list)
+        # (view id, type shortname) -> long ids, in document order
+        self.by_view_type = defaultdict(list)
+        # alignment source long id -> target long ids, and vice versa
+        self.targets = defaultdict(list)
+        self.sources = defaultdict(list)
+
+        for document in mmif.documents:
+            self._add(document.id, document, None)
+        alignments = []
+        for view in mmif.views:
+            for annotation in view.annotations:
+                self._add(self.long_id(view.id, annotation.id), annotation, view.id)
+                if annotation.at_type.shortname == "Alignment":
+                    alignments.append((view.id, annotation))
+        # alignments may refer to annotations further down in their view, so
+        # they are resolved once everything else is in the index
+        for view_id, alignment in alignments:
+            source = self.resolve(view_id, alignment.get("source"))
+            target = self.resolve(view_id, alignment.get("target"))
+            self.targets[source].append(target)
+            self.sources[target].append(source)
+
+    def _add(self, long_id, annotation, view_id):
+        shortname = annotation.at_type.shortname
+        self.annotations[long_id] = annotation
+        self.by_type[shortname].append(long_id)
+        if view_id is not None:
+            self.by_view[view_id].append(long_id)
+            self.by_view_type[(view_id, shortname)].append(long_id)
+
+    @staticmethod
+    def long_id(view_id, annotation_id):
+        if ":" in annotation_id:
+            return annotation_id
+        return f"{view_id}:{annotation_id}"
+
+    def resolve(self, view_id, annotation_id):
+        """
+        Returns the long ID of an annotation referred to from within a view, by
+        long ID, by ID within that view or by top-level document ID.
+        """
+        long_id = self.long_id(view_id, annotation_id)
+        if long_id in self.annotations or annotation_id not in self.annotations:
+            return long_id
+        return annotation_id
+
+    def get(self, view_id, annotation_id):
+        """
+        Returns the annotation referred to from within a view, or None.
+        """
+        return self.annotations.get(self.resolve(view_id, annotation_id))
+
+    def get_annotations(self, shortname, view_id=None):
+        long_ids = self.by_type[shortname] if view_id is None else self.by_view_type[(view_id, shortname)]
+        return [self.annotations[long_id] for long_id in long_ids]
+
+    def get_aligned(self, long_id, shortname=None):
+        """
+        Returns the annotations aligned with an annotation, in either direction,
+        optionally only those of one type.
+        """
+        aligned = []
+        for other_id in self.targets.get(long_id, []) + self.sources.get(long_id, []):
+            other = self.annotations.get(other_id)
+            if other is not None and (shortname is None or other.at_type.shortname == shortname):
+                aligned.append(other)
+        return aligned
@@ -1,16 +1,18 @@
 import datetime
 
-import cv2
 import json
 import re
-import os
-import shutil
 from mmif.vocabulary.annotation_types import AnnotationTypes
 from mmif.vocabulary.document_types import DocumentTypes
 
 from mmif.utils.video_document_helper import convert_timepoint, convert_timeframe
 
+import numpy as np
+
 import cache
+import config
+from mmif_index import get_index
+from thumbnails import get_thumbnails
 
 """
 Helper function for showing debug information
@@ -20,6 +22,10 @@ def some_function(x):
     app.logger.debug(x)
 """
 
+# number of frame pairs whose histograms are compared at once
+_HISTOGRAM_BATCH_SIZE = 64
+
+
 class OCRFrame():
     """
     Class representing an (aligned or otherwise) set of OCR annotations for a single frame
@@ -62,21 +68,12 @@ class OCRFrame():
             self.add_text_document(text_anno)
 
     def add_bounding_box(self, anno, mmif):
+        index = get_index(mmif)
         if "timePoint" in anno.properties:
-            timepoint_anno = mmif[anno.get("timePoint")]
-            
-            if timepoint_anno:
-                self.add_timepoint(timepoint_anno, mmif,
-                                   skip_if_view_has_frames=False)
+            timepoint_anno = index.get(anno.parent, anno.get("timePoint"))
         else:
-            for alignment_anns in mmif.get_alignments(AnnotationTypes.BoundingBox, AnnotationTypes.TimePoint).values():
-                for alignment_ann in alignment_anns:
-                    if alignment_ann.get('source') == anno.long_id:
-                        timepoint_anno = mmif[alignment_ann.get('target')]
-                        break
-                    elif alignment_ann.get('target') == anno.long_id:
-                        timepoint_anno = mmif[alignment_ann.get('source')]
-                        break
+            aligned_timepoints = index.get_aligned(index.long_id(anno.parent, anno.id), "TimePoint")
+            timepoint_anno = aligned_timepoints[0] if aligned_timepoints else None
         if timepoint_anno:
             self.add_timepoint(timepoint_anno, mmif, skip_if_view_has_frames=False)
 
@@ -141,16 +138,25 @@ class OCRFrame():
                 [text_val] if text_val not in self.text else self.text
 
 
-def prepare_ocr(mmif, view, viz_id):
+def prepare_ocr(mmif, view, viz_id, preextract=None):
     """
     Prepares list of frames that will be passed back and forth between server
-    and client, and renders the first page of the OCR.
+    and client, and renders the first page of the OCR. Frames are decoded up
+    front if preextract is set, which defaults to config.PREEXTRACT_FRAMES.
     """
+    if preextract is None:
+        preextract = config.PREEXTRACT_FRAMES
     ocr_frames = get_ocr_frames(view, mmif)
 
     # Generate pages (necessary to reduce IO cost) and render
     frames_list = [(k, vars(v)) for k, v in ocr_frames.items()]
     frames_list = find_duplicates(frames_list)
+    if preextract:
+        # decode the whole view up front, so that visual duplicates are known
+        # before the frames are split into pages
+        vid_path = mmif.get_documents_by_type(DocumentTypes.VideoDocument)[0].location_path()
+        thumbnails = get_thumbnails(vid_path, [get_frame_number(frame) for _, frame in frames_list])
+        check_duplicate_images(frames_list, thumbnails)
     frames_pages = paginate(frames_list)
     # Save page list as temp file
     save_json(frames_pages, view.id, viz_id)
@@ -158,14 +164,15 @@ def prepare_ocr(mmif, view, viz_id):
 
 
 def get_ocr_frames(view, mmif):
+    index = get_index(mmif)
     frames = {}
     full_alignment_type = [
         at_type for at_type in view.metadata.contains if at_type == AnnotationTypes.Alignment]
     # If view contains alignments
     if full_alignment_type:
         for alignment in view.get_annotations(full_alignment_type[0]):
-            source = mmif[alignment.get("source")]
-            target = mmif[alignment.get("target")]
+            source = index.get(view.id, alignment.get("source"))
+            target = index.get(view.id, alignment.get("target"))
 
             # Account for alignment in either direction
             frame = OCRFrame(source, mmif)
@@ -214,13 +221,14 @@ def paginate(frames_list):
     return {i: page for (i, page) in enumerate(pages)}
 
 
-def make_image_directory(mmif_id, view_id):
-    # Make path for temp OCR image files or clear image files if it exists
-    path = cache.get_cache_root() / mmif_id / "img" / view_id
-    if os.path.exists(path):
-        shutil.rmtree(path)
-    os.makedirs(path)
-    return path
+def get_frame_number(frame):
+    """
+    Returns the number of the video frame shown for an OCR frame, which is the
+    midpoint for frames that cover a range.
+    """
+    if frame.get("range"):
+        return (int(frame["range"][0]) + int(frame["range"][1])) // 2
+    return int(frame["frame_num"])
 
 
 def find_duplicates(frames_list):
@@ -255,24 +263,39 @@ def is_duplicate_ocr_frame(prev_frame, frame):
     return False
 
 
-def is_duplicate_image(prev_frame, frame, cv2_vid):
-    # Convert it to HSV
-    img1_hsv = cv2.cvtColor(prev_frame, cv2.COLOR_BGR2HSV)
-    img2_hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-
-    # Calculate the histogram and normalize it
-    hist_img1 = cv2.calcHist([img1_hsv], [0, 1], None, [
-                             180, 256], [0, 180, 0, 256])
-    cv2.normalize(hist_img1, hist_img1, alpha=0,
-                  beta=1, norm_type=cv2.NORM_MINMAX)
-    hist_img2 = cv2.calcHist([img2_hsv], [0, 1], None, [
-                             180, 256], [0, 180, 0, 256])
-    cv2.normalize(hist_img2, hist_img2, alpha=0,
-                  beta=1, norm_type=cv2.NORM_MINMAX)
-
-    # Find the metric value
-    metric_val = cv2.compareHist(hist_img1, hist_img2, cv2.HISTCMP_CHISQR)
-    return metric_val < 50
+def check_duplicate_images(frames_list, thumbnails):
+    """
+    Un-marks "repeat" frames that look significantly different from the frame
+    before them, comparing the stored histograms of the frames in batches.
+    Returns whether any frame was checked, which is remembered in the frames.
+    """
+    frame_nums = [get_frame_number(frame) for _, frame in frames_list]
+    unchecked = [i for i in range(1, len(frames_list))
+                 if frames_list[i][1]["repeat"] and not frames_list[i][1].get("repeat_checked")]
+    for start in range(0, len(unchecked), _HISTOGRAM_BATCH_SIZE):
+        batch = unchecked[start:start + _HISTOGRAM_BATCH_SIZE]
+        batch_frame_nums = sorted({frame_nums[j] for i in batch for j in (i - 1, i)})
+        hists = dict(zip(batch_frame_nums, thumbnails.histograms(batch_frame_nums)))
+        distances = histogram_distances(np.stack([hists[frame_nums[i - 1]] for i in batch]),
+                                        np.stack([hists[frame_nums[i]] for i in batch]))
+        for i, distance in zip(batch, distances):
+            frame = frames_list[i][1]
+            frame["repeat"] = bool(distance < 50)
+            frame["repeat_checked"] = True
+    return bool(unchecked)
+
+
+def histogram_distances(prev_hists, hists):
+    """
+    Chi-square distances between pairs of histograms, the same metric as
+    cv2.compareHist with HISTCMP_CHISQR.
+    """
+    prev_hists = prev_hists.reshape(len(prev_hists), -1)
+    hists = hists.reshape(len(hists), -1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        terms = np.where(np.abs(prev_hists) > np.finfo(prev_hists.dtype).eps,
+                         (hists - prev_hists) ** 2 / prev_hists, 0)
+    return terms.sum(axis=1)
 
 
 def round_boxes(boxes):
@@ -289,6 +312,16 @@ def round_boxes(boxes):
 
 
 def save_json(data, view_id, mmif_id):
-    path = cache.get_cache_root() / mmif_id / f"{view_id}-pages.json"
-    with open(path, 'w') as f:
-        json.dump(data, f)
+    cache.write_artifact(mmif_id, f"{view_id}-pages.json", json.dumps(data))
+
+
+def save_page(page, page_number, view_id, mmif_id):
+    """
+    Writes back one page of the page list of a view, after its frames were
+    checked for duplicates, so that later visits do not check them again.
+    """
+    with cache.file_lock(f"pages-{mmif_id}-{view_id}"):
+        with open(cache.get_cache_root() / mmif_id / f"{view_id}-pages.json") as f:
+            pages = json.load(f)
+        pages[str(page_number)] = page
+        save_json(pages, view_id, mmif_id)
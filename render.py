@@ -1,23 +1,21 @@
 import os
 import pathlib
 from io import StringIO
-from collections import Counter
 from flask import render_template, current_app
-import re
 
-from mmif import DocumentTypes
-from lapps.discriminators import Uri
 import displacy
 import traceback
 
-from utils import get_status, get_properties, get_abstract_view_type, url2posix, get_vtt_file
-from ocr import prepare_ocr, make_image_directory, is_duplicate_image
-import cv2
+from utils import get_status, get_abstract_view_type, url2posix, get_vtt_file, get_vtt_files
+from annotation_rows import build_row_index, COLUMNS
+from annotation_store import get_view_store
+from costs import get_plan, FULL
 import json
-import tempfile
 from urllib import parse
 
 import cache
+import config
+import metrics
 
 """
 Methods to render MMIF documents and their annotations in various formats.
@@ -26,10 +24,25 @@ Methods to render MMIF documents and their annotations in various formats.
 # -- Render methods --
 
 
-def render_documents(mmif, viz_id):
+def warm_up():
     """
-    Returns HTML Tab representation of all documents in the MMIF object.
+    Imports the dependencies that rendering loads lazily (the MMIF SDK, the LAPPS
+    vocabulary, OpenCV), so that the first request for a tab that needs them
+    does not pay for it. Runs in the background on startup if config.WARM_UP is set.
     """
+    import mmif.serialize
+    import lapps.discriminators
+    import ocr
+    import cv2
+
+
+def render_documents(mmif, viz_id, progress=None):
+    """
+    Returns Tab objects for all documents in the MMIF object. Their contents are
+    rendered separately, when they are first requested.
+    The optional progress callback is called with the number of tabs created.
+    """
+    from mmif import DocumentTypes
     tabs = []
     for document in mmif.documents:
         if document.at_type == DocumentTypes.TextDocument:
@@ -40,32 +53,75 @@ def render_documents(mmif, viz_id):
             tabs.append(AudioTab(document, viz_id))
         elif document.at_type == DocumentTypes.VideoDocument:
             tabs.append(VideoTab(document, mmif, viz_id))
+        else:
+            continue
+        if progress:
+            progress(len(tabs))
 
     return tabs
 
 
-def render_annotations(mmif, viz_id):
+def render_annotations(mmif, viz_id, progress=None):
     """
-    Returns HTML Tab representation of all annotations in the MMIF object.
+    Returns Tab objects for all annotations in the MMIF object. Their contents are
+    rendered separately, when they are first requested.
+    The optional progress callback is called with the number of tabs created.
+    Tabs that would be expensive to render in full for a view are rendered in a
+    reduced mode, see costs.py.
     """
+    plan = get_plan(mmif, viz_id)
     tabs = []
     # These tabs should always be present
-    tabs.append(InfoTab(mmif))
-    tabs.append(AnnotationTableTab(mmif))
-    tabs.append(JSTreeTab(mmif))
+    for tab in (InfoTab(mmif, viz_id, plan), AnnotationTableTab(mmif, viz_id, plan), JSTreeTab(mmif, viz_id)):
+        tabs.append(tab)
+        if progress:
+            progress(len(tabs))
     # These tabs are optional
     for view in mmif.views:
         abstract_view_type = get_abstract_view_type(view, mmif)
         if abstract_view_type == "NER":
-            tabs.append(NERTab(mmif, view))
+            tabs.append(NERTab(mmif, view, viz_id))
         elif abstract_view_type == "ASR":
-            tabs.append(VTTTab(mmif, view, viz_id))
+            tabs.append(VTTTab(mmif, view, viz_id, plan.mode("vtt", view.id)))
         elif abstract_view_type == "OCR":
             tabs.append(OCRTab(mmif, view, viz_id))
+        else:
+            continue
+        if progress:
+            progress(len(tabs))
 
     return tabs
 
 
+def get_tab_ids(mmif):
+    """
+    Returns the IDs of the tabs render_documents and render_annotations produce,
+    without creating the tabs.
+    """
+    from mmif import DocumentTypes
+    document_types = (DocumentTypes.TextDocument, DocumentTypes.ImageDocument,
+                      DocumentTypes.AudioDocument, DocumentTypes.VideoDocument)
+    document_ids = [d.id for d in mmif.documents if d.at_type in document_types]
+    view_ids = [v.id for v in mmif.views if get_abstract_view_type(v, mmif) in ("NER", "ASR", "OCR")]
+    return document_ids + ["info", "annotations", "tree"] + view_ids
+
+
+def count_tabs(mmif):
+    """
+    Returns the number of tabs render_documents and render_annotations produce.
+    """
+    return len(get_tab_ids(mmif))
+
+
+def get_tab(mmif, viz_id, tab_id):
+    """
+    Returns the document or annotation Tab object with the given ID, or None.
+    """
+    for tab in render_documents(mmif, viz_id) + render_annotations(mmif, viz_id):
+        if tab.id == tab_id:
+            return tab
+
+
 # -- Base Tab Class --
 
 class DocumentTab():
@@ -73,6 +129,7 @@ class DocumentTab():
         self.id = document.id
         self.tab_name = document.at_type.shortname
         self.viz_id = viz_id
+        self.error = None
 
         try:
             # Add symbolic link to document to static folder, so it can be accessed
@@ -80,15 +137,27 @@ class DocumentTab():
             self.doc_path = document.location_path()
             self.doc_symlink_path = pathlib.Path(
                 current_app.static_folder) / cache._CACHE_DIR_SUFFIX / viz_id / (f"{document.id}.{self.doc_path.split('.')[-1]}")
-            os.symlink(self.doc_path, self.doc_symlink_path)
+            if not os.path.lexists(self.doc_symlink_path):
+                os.symlink(self.doc_path, self.doc_symlink_path)
             self.doc_symlink_rel_path = '/' + \
                 self.doc_symlink_path.relative_to(
                     current_app.static_folder).as_posix()
 
-            self.html = self.render()
-
         except Exception as e:
-            self.html = f"Error rendering document: <br><br> <pre>{traceback.format_exc()}</pre>"
+            self.error = traceback.format_exc()
+
+    def render_html(self):
+        """
+        Renders the tab contents. This happens when the tab is first requested
+        by the browser, see app.display_tab().
+        """
+        if self.error is None:
+            try:
+                with metrics.tab_span(self):
+                    return self.render()
+            except Exception as e:
+                self.error = traceback.format_exc()
+        return f"Error rendering document: <br><br> <pre>{self.error}</pre>"
 
     def __str__(self):
         return f"Tab: {self.tab_name} ({self.id})"
@@ -97,6 +166,7 @@ class DocumentTab():
 class AnnotationTab():
     def __init__(self, mmif, view=None):
         self.mmif = mmif
+        self.error = None
         # Some AnnotationTab sub-classes don't refer to a specific view, and so
         # they specify their own ids and tab names. For ones that do refer to
         # a specific view, we set the ids/tab names based on view properties.
@@ -111,10 +181,18 @@ class AnnotationTab():
 
             self.id = view.id
             self.tab_name = f"{app_shortname}-{view.id}"
+
+    def render_html(self):
+        """
+        Renders the tab contents. This happens when the tab is first requested
+        by the browser, see app.display_tab().
+        """
         try:
-            self.html = self.render()
+            with metrics.tab_span(self):
+                return self.render()
         except Exception as e:
-            self.html = f"Error rendering view: <br><br> <pre>{traceback.format_exc()}</pre>"
+            self.error = traceback.format_exc()
+            return f"Error rendering view: <br><br> <pre>{self.error}</pre>"
 
 
 # -- Document Classes --
@@ -165,13 +243,12 @@ class VideoTab(DocumentTab):
         html = StringIO()
         html.write('<video id="vid" controls crossorigin="anonymous" >\n')
         html.write(f'    <source src=\"{vid_path}\">\n')
-        for view in self.mmif.views:
-            if get_abstract_view_type(view, self.mmif) == "ASR":
-                vtt_path = get_vtt_file(view, self.viz_id)
-                rel_vtt_path = re.search(
-                    "mmif-viz-cache/.*", vtt_path).group(0)
-                html.write(
-                    f'    <track kind="captions" srclang="en" src="/{rel_vtt_path}" label="transcript" default/>\n')
+        asr_views = [view for view in self.mmif.views if get_abstract_view_type(view, self.mmif) == "ASR"]
+        vtt_paths = get_vtt_files(asr_views, self.viz_id, self.mmif)
+        for view in asr_views:
+            vtt_name = pathlib.Path(vtt_paths[view.id]).name
+            html.write(
+                f'    <track kind="captions" srclang="en" src="/{cache._CACHE_DIR_SUFFIX}/{self.viz_id}/{vtt_name}" label="transcript" default/>\n')
         html.write("</video>\n")
         return html.getvalue()
 
@@ -179,9 +256,11 @@ class VideoTab(DocumentTab):
 # -- Annotation Classes --
 
 class InfoTab(AnnotationTab):
-    def __init__(self, mmif):
+    def __init__(self, mmif, viz_id, plan):
         self.id = "info"
         self.tab_name = "Info"
+        self.viz_id = viz_id
+        self.plan = plan
         super().__init__(mmif)
 
     def render(self):
@@ -196,83 +275,102 @@ class InfoTab(AnnotationTab):
         for view in mmif.views:
             app = view.metadata.app
             status = get_status(view)
+            store = get_view_store(self.viz_id, view.id)
             s.write('%s  %s  %s  %d\n' %
-                    (view.id, app, status, len(view.annotations)))
-            if len(view.annotations) > 0:
+                    (view.id, app, status, len(store)))
+            if len(store) > 0:
                 s.write('\n')
-                types = Counter([a.at_type.shortname
-                                for a in view.annotations])
-                for attype, count in types.items():
+                for attype, count in store.count_types().items():
                     s.write('    %4d %s\n' % (count, attype))
             s.write('\n')
+        s.write('Rendering modes\n\n')
+        for line in self.plan.describe():
+            s.write('    %s\n' % line)
         s.write("</pre>")
         return s.getvalue()
 
 
 class AnnotationTableTab(AnnotationTab):
-    def __init__(self, mmif):
+    def __init__(self, mmif, viz_id, plan):
         self.id = "annotations"
         self.tab_name = "Annotations"
+        self.viz_id = viz_id
+        self.plan = plan
         super().__init__(mmif)
 
     def render(self):
-        mmif = self.mmif
-        s = StringIO('Howdy')
-        for view in mmif.views:
-            status = get_status(view)
-            s.write('<p><b>%s  %s</b>  %s  %d annotations</p>\n'
-                    % (view.id, view.metadata.app, status, len(view.annotations)))
-            s.write("<blockquote>\n")
-            s.write("<table cellspacing=0 cellpadding=5 border=1>\n")
-            def limit_len(str): return str[:500] + \
-                "  . . .  }" if len(str) > 500 else str
-            for annotation in view.annotations:
-                s.write('  <tr>\n')
-                s.write('    <td>%s</td>\n' % annotation.id)
-                s.write('    <td>%s</td>\n' % annotation.at_type.shortname)
-                s.write('    <td>%s</td>\n' %
-                        limit_len(get_properties(annotation)))
-                s.write('  </tr>\n')
-            s.write("</table>\n")
-            s.write("</blockquote>\n")
-        return s.getvalue()
+        # only the table headers, the rows are served page by page from the
+        # row index, see app.annotation_rows(); views summarized by the plan
+        # are indexed when their rows are first asked for
+        indexed = [view.id for view in self.mmif.views if self.plan.mode("table", view.id) == FULL]
+        views = build_row_index(self.mmif, self.viz_id, indexed)
+        for view in views:
+            if view["id"] not in indexed:
+                view["types"] = get_view_store(self.viz_id, view["id"]).count_types()
+        return render_template('annotation-table.html', views=views, columns=COLUMNS, viz_id=self.viz_id)
 
 
 class JSTreeTab(AnnotationTab):
-    def __init__(self, mmif):
+    def __init__(self, mmif, viz_id):
         self.id = "tree"
         self.tab_name = "Tree"
+        self.viz_id = viz_id
         super().__init__(mmif)
 
     def render(self):
-        mmif = self.mmif
-        return render_template('interactive.html', mmif=mmif, aligned_views=[])
+        # the nodes are loaded as they are opened, see app.tree_nodes()
+        return render_template('interactive.html', viz_id=self.viz_id)
 
 
 class NERTab(AnnotationTab):
-    def __init__(self, mmif, view):
+    def __init__(self, mmif, view, viz_id):
+        self.viz_id = viz_id
         super().__init__(mmif, view)
 
     def render(self):
+        from lapps.discriminators import Uri
         metadata = self.view.metadata.contains.get(Uri.NE)
         ner_document = metadata.get('document')
-        return displacy.visualize_ner(self.mmif, self.view, ner_document, current_app.root_path)
+        # only the first window of the text, further ones are requested by the
+        # page as the user scrolls to them, see app.ner_window()
+        displacy.build_ner_index(self.mmif, self.view, ner_document, self.viz_id)
+        html, next_start = displacy.visualize_ner_window(self.viz_id, self.view.id)
+        return render_template('ner.html', html=html, next_start=next_start,
+                               viz_id=self.viz_id, view_id=self.view.id)
 
 
 class VTTTab(AnnotationTab):
-    def __init__(self, mmif, view, viz_id):
+    # number of cues shown in summary mode
+    PREVIEW_CUES = 200
+
+    def __init__(self, mmif, view, viz_id, mode=FULL):
         self.viz_id = viz_id
+        self.mode = mode
         super().__init__(mmif, view)
 
     def render(self):
-        vtt_filename = get_vtt_file(self.view, self.viz_id)
+        vtt_filename = get_vtt_file(self.view, self.viz_id, self.mmif)
         with open(vtt_filename) as vtt_file:
-            vtt_content = vtt_file.read()
-        return f"<pre>{vtt_content}</pre>"
+            if self.mode == FULL:
+                return f"<pre>{vtt_file.read()}</pre>"
+            # cues are separated by blank lines, after the WEBVTT header
+            lines = []
+            n_cues = -1
+            for line in vtt_file:
+                if not line.strip():
+                    n_cues += 1
+                    if n_cues == self.PREVIEW_CUES:
+                        break
+                lines.append(line)
+        vtt_url = f"/{cache._CACHE_DIR_SUFFIX}/{self.viz_id}/{pathlib.Path(vtt_filename).name}"
+        return (f'<p>Showing the first {self.PREVIEW_CUES} captions of a long transcript, '
+                f'<a href="{vtt_url}" target="_blank">open all captions</a>.</p>'
+                f'<pre>{"".join(lines)}</pre>')
 
 
 class OCRTab(AnnotationTab):
     def __init__(self, mmif, view, viz_id):
+        from mmif import DocumentTypes
         self.viz_id = viz_id
         self.vid_path = mmif.get_documents_by_type(DocumentTypes.VideoDocument)[
             0].location_path()
@@ -291,33 +389,44 @@ def render_ocr_page(mmif_id, vid_path, view_id, page_number):
     contents/alignments. Note: this needs to be a separate function (not a method
     in OCRTab) because it is called by the server when the page is changed.
     """
-    # Path for storing temporary images generated by cv2
-    cv2_vid = cv2.VideoCapture(vid_path)
+    from ocr import get_frame_number, check_duplicate_images, save_page
+    from thumbnails import get_thumbnails, cancel_prefetch
     tn_data_fname = cache.get_cache_root() / mmif_id / f"{view_id}-pages.json"
     thumbnail_pages = json.load(open(tn_data_fname))
     page = thumbnail_pages[str(page_number)]
-    prev_frame_cap = None
-    path = make_image_directory(mmif_id, view_id)
-    for frame_num, frame in page:
-        # If index is range instead of frame...
-        if frame.get("range"):
-            frame_num = (int(frame["range"][0]) + int(frame["range"][1])) / 2
-        cv2_vid.set(1, frame_num)
-        _, frame_cap = cv2_vid.read()
-        if frame_cap is None:
-            raise FileNotFoundError(f"Video file {vid_path} not found!")
-
-        # Double check histogram similarity of "repeat" frames -- if they're significantly different, un-mark as repeat
-        if prev_frame_cap is not None and frame["repeat"] and not is_duplicate_image(prev_frame_cap, frame_cap,
-                                                                                     cv2_vid):
-            frame["repeat"] = False
-        with tempfile.NamedTemporaryFile(dir=str(path), suffix=".jpg", delete=False) as tf:
-            cv2.imwrite(tf.name, frame_cap)
-            # "id" is just the name of the temp image file
-            frame["id"] = pathlib.Path(tf.name).name
-        prev_frame_cap = frame_cap
+    frame_nums = [get_frame_number(frame) for _, frame in page]
+    # the user moved on, stop decoding around the previous page, except for
+    # the frames of this page
+    cancel_prefetch((mmif_id, view_id), keep=frame_nums)
+    thumbnails = get_thumbnails(vid_path, frame_nums)
+    # Double check histogram similarity of "repeat" frames -- if they're significantly different, un-mark as repeat
+    if check_duplicate_images(page, thumbnails):
+        save_page(page, page_number, view_id, mmif_id)
+    for _, frame in page:
+        frame_num = get_frame_number(frame)
+        frame["id"] = f"{view_id}-{frame_num}"
+        frame["img"] = thumbnails.paths[frame_num]
+        frame["scale"] = thumbnails.scale
+
+    prefetch_ocr_pages(mmif_id, vid_path, view_id, thumbnail_pages, int(page_number))
 
     tn_page_html = render_template(
         'ocr.html', vid_path=vid_path, view_id=view_id, page=page,
         n_pages=len(thumbnail_pages), page_number=str(page_number), mmif_id=mmif_id)
     return tn_page_html
+
+
+def prefetch_ocr_pages(mmif_id, vid_path, view_id, thumbnail_pages, page_number):
+    """
+    Starts decoding the frames of the pages around the current one, nearest
+    first and the next page before the previous one, so that page flips are
+    served from the thumbnail store.
+    """
+    from ocr import get_frame_number
+    from thumbnails import prefetch_thumbnails
+    page_numbers = []
+    for distance in range(1, config.PREFETCH_PAGES + 1):
+        page_numbers += [page_number + distance, page_number - distance]
+    frame_groups = [[get_frame_number(frame) for _, frame in thumbnail_pages[str(n)]]
+                    for n in page_numbers if str(n) in thumbnail_pages]
+    prefetch_thumbnails((mmif_id, view_id), vid_path, frame_groups)
@@ -0,0 +1,238 @@
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import cache
+import config
+import metrics
+import workers
+
+"""
+Store of decoded video frames. Thumbnails are kept in the cache root, in one
+directory per video file (keyed by path and modification time), so they are
+shared by all pages, OCR views and visualizations that refer to the same video.
+Each store directory is tracked by the cache catalog like a visualization.
+"""
+
+_STORE_PREFIX = "thumbnails-"
+# smallest number of frames worth handing to a separate decoding process
+_MIN_SEGMENT_LENGTH = 8
+_prefetch_pool = ThreadPoolExecutor(max_workers=max(1, config.PREFETCH_WORKERS), thread_name_prefix="prefetch")
+# prefetch key -> [(cancellation event, future, frame numbers)], one per task
+_prefetches = {}
+_prefetches_lock = threading.Lock()
+
+
+class Thumbnails():
+    """
+    Thumbnails of a set of frames: ``paths`` maps frame numbers to image paths
+    relative to the cache root and ``scale`` is the thumbnail to video size ratio.
+    """
+
+    def __init__(self, store_id, paths, scale):
+        self.store_id = store_id
+        self.paths = paths
+        self.scale = scale
+
+    def histograms(self, frame_nums):
+        """
+        Returns the stacked color histograms of the given frames, which were
+        computed once when the frames were decoded.
+        """
+        store_path = cache.get_cache_root() / self.store_id
+        return np.stack([np.load(store_path / histogram_name(n))["hist"] for n in frame_nums])
+
+
+def get_store_id(vid_path):
+    mtime = os.stat(vid_path).st_mtime_ns
+    key = hashlib.sha1(f"{os.path.abspath(vid_path)}:{mtime}".encode()).hexdigest()
+    return f"{_STORE_PREFIX}{key}"
+
+
+def is_thumbnail(store_id, filename):
+    """
+    Returns whether a file of the cache is a thumbnail, whose content is fixed
+    by its name (frame and width) and store (video path and modification time).
+    """
+    return store_id.startswith(_STORE_PREFIX) and filename.endswith(".jpg")
+
+
+def thumbnail_name(frame_num, width=None):
+    return f"{frame_num}-{width or config.THUMBNAIL_WIDTH}.jpg"
+
+
+def histogram_name(frame_num):
+    return f"{frame_num}.hist.npz"
+
+
+def get_thumbnails(vid_path, frame_nums, width=None, cancel=None):
+    """
+    Returns the thumbnails for the given frames of a video, decoding only those
+    frames that are not in the store yet. Decoding stops early when the optional
+    ``cancel`` event is set.
+    """
+    width = width or config.THUMBNAIL_WIDTH
+    store_id = get_store_id(vid_path)
+    store_path = cache.get_cache_root() / store_id
+    # held (shared with other decoders of the video) so that cache.cleanup()
+    # does not evict the store while frames are written to it
+    with cache.render_lock(store_id, shared=True):
+        os.makedirs(store_path, exist_ok=True)
+        cache.set_last_access(store_path)
+        missing = sorted({n for n in frame_nums
+                          if not (store_path / thumbnail_name(n, width)).exists()
+                          or not (store_path / histogram_name(n)).exists()})
+        metrics.count_lookup("frames", hit=True, amount=len(set(frame_nums)) - len(missing))
+        metrics.count_lookup("frames", hit=False, amount=len(missing))
+        if missing or not (store_path / "video.json").exists():
+            with metrics.span("decode_frames"):
+                video_width = decode_thumbnails(vid_path, store_id, missing, width, cancel)
+        else:
+            with open(store_path / "video.json") as f:
+                video_width = json.load(f)["width"]
+    paths = {n: f"{store_id}/{thumbnail_name(n, width)}" for n in frame_nums}
+    return Thumbnails(store_id, paths, min(1, width / video_width))
+
+
+def decode_thumbnails(vid_path, store_id, frame_nums, width, cancel=None):
+    """
+    Decodes the given (sorted) frames, writes them to the store at reduced
+    resolution and returns the width of the video. Larger sets of frames are
+    split into contiguous segments that are decoded by the worker processes,
+    each with its own VideoCapture, unless decoding can be cancelled.
+    """
+    n_segments = min(config.DECODE_WORKERS, len(frame_nums) // _MIN_SEGMENT_LENGTH)
+    if cancel is None and n_segments > 1:
+        size = -(-len(frame_nums) // n_segments)
+        segments = [frame_nums[i:i + size] for i in range(0, len(frame_nums), size)]
+        n = len(segments)
+        return max(workers.parallel_map(decode_segment, [vid_path] * n, [store_id] * n, segments, [width] * n))
+    return decode_segment(vid_path, store_id, frame_nums, width, cancel)
+
+
+def decode_segment(vid_path, store_id, frame_nums, width, cancel=None):
+    import cv2
+    cv2_vid = cv2.VideoCapture(vid_path)
+    try:
+        video_width = cv2_vid.get(cv2.CAP_PROP_FRAME_WIDTH)
+        if not video_width:
+            raise FileNotFoundError(f"Video file {vid_path} not found!")
+        cache.write_artifact(store_id, "video.json", json.dumps(
+            {"width": video_width, "height": cv2_vid.get(cv2.CAP_PROP_FRAME_HEIGHT)}))
+        for frame_num, frame_cap in read_frames(cv2_vid, frame_nums):
+            if cancel is not None and cancel.is_set():
+                break
+            if frame_cap is None:
+                raise FileNotFoundError(f"Video file {vid_path} not found!")
+            write_thumbnail(store_id, frame_num, frame_cap, width)
+    finally:
+        cv2_vid.release()
+    return video_width
+
+
+def prefetch_thumbnails(key, vid_path, frame_groups):
+    """
+    Decodes groups of frames in the background, one task per group in the given
+    order. A new prefetch with the same key (e.g. the same OCR view) cancels the
+    tasks of the previous one that are still pending or running.
+    """
+    if config.PREFETCH_WORKERS < 1:
+        return
+    with _prefetches_lock:
+        _cancel_prefetch(key)
+        tasks = []
+        for frame_nums in frame_groups:
+            if frame_nums:
+                cancel = threading.Event()
+                tasks.append((cancel, _prefetch_pool.submit(_prefetch, vid_path, frame_nums, cancel), frame_nums))
+        _prefetches[key] = tasks
+
+
+def cancel_prefetch(key, keep=()):
+    """
+    Cancels the prefetch tasks with a key, except running ones that decode any
+    of the frames in ``keep``: those are waited for, so that frames about to be
+    requested are not decoded twice.
+    """
+    keep = set(keep)
+    running = []
+    with _prefetches_lock:
+        for cancel, future, frame_nums in _prefetches.pop(key, []):
+            if not keep.isdisjoint(frame_nums) and not future.cancel():
+                running.append(future)
+            else:
+                cancel.set()
+    for future in running:
+        future.result()
+
+
+def _cancel_prefetch(key):
+    for cancel, future, _ in _prefetches.pop(key, []):
+        cancel.set()
+        future.cancel()
+
+
+def _prefetch(vid_path, frame_nums, cancel):
+    if cancel.is_set():
+        return
+    try:
+        get_thumbnails(vid_path, frame_nums, cancel=cancel)
+    except Exception:
+        logging.exception(f"Prefetching frames of {vid_path} failed")
+
+
+def read_frames(cv2_vid, frame_nums, seek_threshold=None):
+    """
+    Yields (frame number, image) for the given frames in one forward pass over
+    the video. Frames between two requested ones are grabbed but not converted,
+    and the decoder only seeks (to the preceding keyframe, then decoding forward)
+    when the gap is larger than the seek threshold.
+    """
+    import cv2
+    if seek_threshold is None:
+        seek_threshold = config.SEEK_THRESHOLD
+    # number of the frame the next grab() returns
+    position = None
+    for frame_num in sorted(set(frame_nums)):
+        if position is None or frame_num - position > seek_threshold:
+            cv2_vid.set(cv2.CAP_PROP_POS_FRAMES, frame_num)
+            position = frame_num
+        grabbed = True
+        while grabbed and position <= frame_num:
+            grabbed = cv2_vid.grab()
+            position += 1
+        frame_cap = cv2_vid.retrieve()[1] if grabbed else None
+        yield frame_num, frame_cap
+
+
+def image_histogram(frame_cap):
+    """
+    Normalized hue/saturation histogram of an image, used to tell apart frames
+    that look alike from ones that do not.
+    """
+    import cv2
+    img_hsv = cv2.cvtColor(frame_cap, cv2.COLOR_BGR2HSV)
+    hist = cv2.calcHist([img_hsv], [0, 1], None, [180, 256], [0, 180, 0, 256])
+    cv2.normalize(hist, hist, alpha=0, beta=1, norm_type=cv2.NORM_MINMAX)
+    return hist
+
+
+def write_thumbnail(store_id, frame_num, frame_cap, width):
+    import cv2
+    # the histogram is taken from the full-size frame, and compressed since it
+    # is mostly zeros
+    hist_file = io.BytesIO()
+    np.savez_compressed(hist_file, hist=image_histogram(frame_cap))
+    cache.write_artifact(store_id, histogram_name(frame_num), hist_file.getvalue())
+    height, frame_width = frame_cap.shape[:2]
+    if frame_width > width:
+        frame_cap = cv2.resize(frame_cap, (width, round(height * width / frame_width)),
+                               interpolation=cv2.INTER_AREA)
+    _, jpg = cv2.imencode(".jpg", frame_cap)
+    cache.write_artifact(store_id, thumbnail_name(frame_num, width), jpg.tobytes())
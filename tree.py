@@ -0,0 +1,153 @@
+from markupsafe import escape
+
+from annotation_rows import ensure_row_index, select_rows
+from annotation_store import get_view_store
+from costs import get_plan, ON_DEMAND
+from mmif_index import get_index
+
+"""
+Nodes of the Tree tab, served to jsTree a level at a time as it opens them:
+views, then annotations (in chunks for large views), then their properties.
+Searching restricts the tree to annotations matching the search string, using
+the row index of the annotations table. Views too large to index (see costs.py)
+are grouped by annotation type instead, from the columnar store, with nested
+ranges of annotations, and are left out of searches.
+"""
+
+# maximum number of annotations shown under one node
+CHUNK_SIZE = 100
+
+
+def get_children(mmif, viz_id, node_id, search=None):
+    """
+    Returns the children of a node as jsTree JSON, "#" being the root. Node IDs
+    are "view/<view id>", "chunk/<view id>/<start>" and "annotation/<view id>/<position>",
+    and in views grouped by type "type/<view id>/<type>" and
+    "range/<view id>/<type>/<start>/<end>".
+    """
+    if node_id == "#":
+        return get_view_nodes(mmif, viz_id, search)
+    kind, _, rest = node_id.partition("/")
+    view_id, _, position = rest.rpartition("/")
+    if kind == "view" and get_plan(mmif, viz_id).mode("tree", rest) == ON_DEMAND:
+        return get_type_nodes(viz_id, rest)
+    if kind in ("type", "range"):
+        if kind == "type":
+            shortname = position
+            start, end = 0, None
+        else:
+            view_id, shortname, start, end = rest.rsplit("/", 3)
+        if get_plan(mmif, viz_id).mode("tree", view_id) != ON_DEMAND:
+            raise KeyError(node_id)
+        positions = get_view_store(viz_id, view_id).select_type(shortname)
+        end = len(positions) if end is None else int(end)
+        return get_range_nodes(mmif, view_id, shortname, positions, int(start), end)
+    if kind == "view":
+        view_id = rest
+        positions = get_positions(viz_id, view_id, search)
+        if len(positions) > CHUNK_SIZE:
+            return [{"id": f"chunk/{view_id}/{start}",
+                     "text": f"annotations {start + 1}-{min(start + CHUNK_SIZE, len(positions))}",
+                     "type": "chunk",
+                     "children": True}
+                    for start in range(0, len(positions), CHUNK_SIZE)]
+        return get_annotation_nodes(mmif, view_id, positions)
+    if kind == "chunk":
+        start = int(position)
+        positions = get_positions(viz_id, view_id, search)[start:start + CHUNK_SIZE]
+        return get_annotation_nodes(mmif, view_id, positions)
+    if kind == "annotation":
+        annotation = get_annotation(mmif, view_id, int(position))
+        return [{"id": f"properties/{view_id}/{position}",
+                 "text": str(escape(str(annotation.properties))),
+                 "type": "properties",
+                 "children": False}]
+    raise KeyError(node_id)
+
+
+def get_view_nodes(mmif, viz_id, search=None):
+    plan = get_plan(mmif, viz_id)
+    nodes = []
+    for view in mmif.views:
+        text = f"{view.metadata.app} ({view.id})"
+        if plan.mode("tree", view.id) == ON_DEMAND:
+            text += f" - {len(view.annotations)} annotations, not searched"
+        elif search:
+            n_matches = len(get_positions(viz_id, view.id, search))
+            if not n_matches:
+                continue
+            text += f" - {n_matches} matches"
+        nodes.append({"id": f"view/{view.id}",
+                      "text": str(escape(text)),
+                      "type": "view",
+                      "children": len(view.annotations) > 0})
+    return nodes
+
+
+def get_type_nodes(viz_id, view_id):
+    return [{"id": f"type/{view_id}/{shortname}",
+             "text": str(escape(f"{shortname} ({count})")),
+             "type": "chunk",
+             "children": True}
+            for shortname, count in get_view_store(viz_id, view_id).count_types().items()]
+
+
+def get_range_nodes(mmif, view_id, shortname, positions, start, end):
+    """
+    Returns the annotations at positions[start:end] (the positions of the
+    annotations of one type) if there are at most CHUNK_SIZE of them, otherwise
+    at most CHUNK_SIZE nested ranges covering them.
+    """
+    if end - start <= CHUNK_SIZE:
+        return get_annotation_nodes(mmif, view_id, [int(position) for position in positions[start:end]])
+    size = CHUNK_SIZE
+    while size * CHUNK_SIZE < end - start:
+        size *= CHUNK_SIZE
+    return [{"id": f"range/{view_id}/{shortname}/{first}/{min(first + size, end)}",
+             "text": f"annotations {first + 1}-{min(first + size, end)}",
+             "type": "chunk",
+             "children": True}
+            for first in range(start, end, size)]
+
+
+def get_annotation(mmif, view_id, position):
+    """
+    Returns the annotation at a position in a view.
+    """
+    index = get_index(mmif)
+    if view_id not in index.by_view:
+        raise KeyError(view_id)
+    return index.annotations[index.by_view[view_id][position]]
+
+
+def get_annotation_nodes(mmif, view_id, positions):
+    return [{"id": f"annotation/{view_id}/{position}",
+             "text": str(escape(str(get_annotation(mmif, view_id, position).at_type))),
+             "type": "annotation",
+             "children": True}
+            for position in positions]
+
+
+def get_positions(viz_id, view_id, search=None):
+    """
+    Returns the positions of the annotations of a view that match the search
+    string, or of all of them.
+    """
+    if not ensure_row_index(viz_id, view_id):
+        raise KeyError(view_id)
+    return select_rows(viz_id, view_id, search=search)
+
+
+def search(mmif, viz_id, query):
+    """
+    Returns the number of annotations matching the query in each view with matches.
+    """
+    plan = get_plan(mmif, viz_id)
+    results = []
+    for view in mmif.views:
+        if plan.mode("tree", view.id) == ON_DEMAND:
+            continue
+        n_matches = len(get_positions(viz_id, view.id, query))
+        if n_matches:
+            results.append({"view_id": view.id, "app": view.metadata.app, "matches": n_matches})
+    return results
@@ -1,7 +1,11 @@
-from mmif.serialize.annotation import Text
+import os
+import tempfile
+
 from flask import current_app
 import cache
-import mmif_docloc_baapb
+import config
+import metrics
+from mmif_index import get_index
 
 
 def url2posix(path):
@@ -10,6 +14,7 @@ def url2posix(path):
     if str(path).startswith('file:///'):
         path = path[7:]
     elif str(path).startswith('baapb://'):
+        import mmif_docloc_baapb
         path = mmif_docloc_baapb.resolve(path)
     return path
 
@@ -19,6 +24,7 @@ def get_status(view):
 
 
 def get_properties(annotation):
+    from mmif.serialize.annotation import Text
     props = annotation.properties._serialize()
     props.pop('id')
     props_list = []
@@ -51,58 +57,137 @@ def get_abstract_view_type(view, mmif):
     #                 return "OCR"
                 
                 
-def get_vtt_file(view, viz_id):
-    vtt_filename = cache.get_cache_root() / viz_id / \
-        f"{view.id.replace(':', '-')}.vtt"
-    if not vtt_filename.exists():
-        with open(vtt_filename, 'w') as vtt_file:
-            vtt_file.write(write_vtt(view, viz_id))
-    return str(vtt_filename)
-
-
-def write_vtt(view, viz_id):
-    vtt = "WEBVTT\n\n"
-    timeunit = "milliseconds"
-    for a in view.metadata.contains.values():
-        if "timeUnit" in a:
-            timeunit = a["timeUnit"]
-            break
-    token_idx = {
-        a.id: a for a in view.annotations if a.at_type.shortname == "Token"}
-    timeframe_idx = {
-        a.id: a for a in view.annotations if a.at_type.shortname == "TimeFrame"}
-    alignments = [
-        a for a in view.annotations if a.at_type.shortname == "Alignment"]
-    vtt_start = None
-    texts = []
-    for alignment in alignments:
-        start_end_text = build_alignment(alignment, token_idx, timeframe_idx)
-        if start_end_text is None:
-            continue
-        start, end, text = start_end_text
-        if not vtt_start:
-            vtt_start = format_time(start, timeunit)
-        texts.append(text)
-        if len(texts) > 8:
-            vtt_end = format_time(end, timeunit)
-            vtt += f"{vtt_start} --> {vtt_end}\n{' '.join(texts)}\n\n"
-            vtt_start = None
-            texts = []
-    return vtt
-
-
-def build_alignment(alignment, token_idx, timeframe_idx):
-    target = alignment.properties['target']
-    source = alignment.properties['source']
-    timeframe = timeframe_idx.get(source)
-    token = token_idx.get(target)
-    if timeframe and token:
-        start = timeframe.properties['start']
-        end = timeframe.properties['end']
+def get_vtt_file(view, viz_id, mmif):
+    return get_vtt_files([view], viz_id, mmif)[view.id]
+
+
+def get_vtt_files(views, viz_id, mmif):
+    """
+    Returns the paths of the WebVTT caption files of ASR views by view ID. The
+    files that do not exist yet are written together, in one pass over the
+    alignments of the MMIF file.
+    """
+    paths = {view.id: cache.get_cache_root() / viz_id / f"{view.id.replace(':', '-')}.vtt"
+             for view in views}
+    if not all(path.exists() for path in paths.values()):
+        with cache.file_lock(f"vtt-{viz_id}"):
+            missing = [view for view in views if not paths[view.id].exists()]
+            if missing:
+                with metrics.span("write_vtt"):
+                    write_vtt_files(missing, {view.id: paths[view.id] for view in missing}, mmif)
+                for view in missing:
+                    cache.record_artifact(viz_id, paths[view.id])
+                    cache.write_compressed(viz_id, paths[view.id].name)
+    return {view_id: str(path) for view_id, path in paths.items()}
+
+
+def write_vtt_files(views, paths, mmif):
+    """
+    Streams the captions of several ASR views to their files. Cues are written
+    as soon as they are complete, so only the tokens of the current cue of each
+    view are held in memory.
+    """
+    index = get_index(mmif)
+    default_units = {view.id: get_default_time_unit(view) for view in views}
+    tmp_files = {view.id: tempfile.NamedTemporaryFile('w', dir=paths[view.id].parent,
+                                                      prefix=f".{paths[view.id].name}.", delete=False)
+                 for view in views}
+    try:
+        writers = {view_id: CueWriter(tmp_file) for view_id, tmp_file in tmp_files.items()}
+        for long_id in index.by_type["Alignment"]:
+            alignment = index.annotations[long_id]
+            writer = writers.get(alignment.parent)
+            if writer is None:
+                continue
+            start_end_text = build_alignment(alignment, alignment.parent, index, default_units[alignment.parent])
+            if start_end_text is not None:
+                writer.add(*start_end_text)
+        for writer in writers.values():
+            writer.flush()
+    finally:
+        for tmp_file in tmp_files.values():
+            tmp_file.close()
+    for view_id, tmp_file in tmp_files.items():
+        os.replace(tmp_file.name, paths[view_id])
+
+
+class CueWriter():
+    """
+    Writes tokens to a WebVTT file as cues. A cue ends when it has the maximum
+    number of tokens, when adding the next token would make it longer than the
+    maximum duration, or when there is a long enough pause before the next token
+    (see the VTT_CUE_* settings in config.py).
+    """
+
+    def __init__(self, vtt_file):
+        self.vtt_file = vtt_file
+        self.start = None
+        self.end = None
+        self.texts = []
+        self.vtt_file.write("WEBVTT\n\n")
+
+    def add(self, start, end, text):
+        """
+        Adds a token, with start and end times in milliseconds.
+        """
+        if self.texts and self.is_cue_boundary(start, end):
+            self.flush()
+        if not self.texts:
+            self.start = start
+        self.texts.append(text)
+        self.end = end
+        if 0 < config.VTT_CUE_TOKENS <= len(self.texts):
+            self.flush()
+
+    def is_cue_boundary(self, start, end):
+        if config.VTT_CUE_MAX_PAUSE and start - self.end > config.VTT_CUE_MAX_PAUSE * 1000:
+            return True
+        if config.VTT_CUE_MAX_DURATION and end - self.start > config.VTT_CUE_MAX_DURATION * 1000:
+            return True
+        return False
+
+    def flush(self):
+        if self.texts:
+            self.vtt_file.write(f"{format_time(self.start, 'milliseconds')} --> "
+                                f"{format_time(self.end, 'milliseconds')}\n{' '.join(self.texts)}\n\n")
+            self.texts = []
+
+
+def get_default_time_unit(view):
+    """
+    Returns the time unit of a view's TimeFrames that do not specify one, which
+    is the one given for TimeFrames in the view metadata, or milliseconds.
+    """
+    for at_type, metadata in view.metadata.contains.items():
+        if at_type.shortname == "TimeFrame" and "timeUnit" in metadata:
+            return metadata["timeUnit"]
+    return "milliseconds"
+
+
+def build_alignment(alignment, view_id, index, default_unit="milliseconds"):
+    """
+    Returns the start and end time in milliseconds and the word of a TimeFrame
+    to Token alignment, or None for other alignments.
+    """
+    timeframe = index.get(view_id, alignment.properties['source'])
+    token = index.get(view_id, alignment.properties['target'])
+    if timeframe and token and timeframe.at_type.shortname == "TimeFrame" \
+            and token.at_type.shortname == "Token":
+        # TimeFrames may have their own unit, directly or through the
+        # metadata of the view they are in
+        unit = timeframe.get("timeUnit") if "timeUnit" in timeframe else default_unit
+        start = to_milliseconds(timeframe.properties['start'], unit)
+        end = to_milliseconds(timeframe.properties['end'], unit)
         text = token.properties['word']
         return start, end, text
 
 
+def to_milliseconds(time, unit):
+    if unit == "seconds":
+        return int(time * 1000)
+    return int(time)
+
+
 def format_time(time, unit):
     """
     Formats a time in seconds as a string in the format "hh:mm:ss.fff"
@@ -111,10 +196,7 @@ def format_time(time, unit):
     (https://developer.mozilla.org/en-US/docs/Web/API/WebVTT_API)
     ISO format can have up to 6 below the decimal point, on the other hand
     """
-    if unit == "seconds":
-        time_in_ms = int(time * 1000)
-    else:
-        time_in_ms = int(time)
+    time_in_ms = to_milliseconds(time, unit)
     hours = time_in_ms // (1000 * 60 * 60)
     time_in_ms %= (1000 * 60 * 60)
     minutes = time_in_ms // (1000 * 60)
@@ -0,0 +1,81 @@
+import json
+import logging
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+import cache
+import metrics
+import mmif_cache
+
+"""
+Schema validation of uploaded MMIF files in the background, for deployments
+that load them without validating (config.FAST_LOAD, see mmif_cache.get_mmif()).
+The result is written to the visualization directory, reported by /status and
+shown as a warning on the page if the file is not valid.
+"""
+
+VALIDATION_FILENAME = "validation.json"
+# the result states
+PENDING, VALID, INVALID, FAILED = "pending", "valid", "invalid", "failed"
+
+# one thread, validation is not urgent and should not compete with rendering
+_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="validate")
+
+
+def submit(viz_id, mmif_str):
+    """
+    Queues the validation of the MMIF file of a visualization.
+    """
+    write_result(viz_id, PENDING)
+    _pool.submit(_run, viz_id, mmif_str)
+
+
+def _run(viz_id, mmif_str):
+    try:
+        write_result(viz_id, *validate(mmif_str))
+    except Exception as e:
+        # including failures to import the validator, so that the result is
+        # never left pending
+        logging.error(f"Validating {viz_id} failed: {e}\n{traceback.format_exc()}")
+        write_result(viz_id, FAILED, str(e))
+
+
+def validate(mmif_str):
+    """
+    Validates a MMIF string against the MMIF schema, returns the result state
+    and the reason it is not valid.
+    """
+    import jsonschema
+    from mmif.serialize import Mmif
+    try:
+        with metrics.span("validate_mmif"):
+            Mmif.validate(mmif_cache.load_json(mmif_str))
+    except jsonschema.ValidationError as e:
+        location = "/".join(str(part) for part in e.absolute_path)
+        return INVALID, f"{e.message} (at /{location})"
+    except ValueError as e:
+        return INVALID, f"Not a JSON file: {e}"
+    return VALID, None
+
+
+def write_result(viz_id, state, message=None):
+    """
+    Writes the validation result of a visualization, unless the visualization
+    was evicted in the meantime.
+    """
+    try:
+        cache.write_artifact(viz_id, VALIDATION_FILENAME, json.dumps({"state": state, "message": message}))
+    except FileNotFoundError:
+        logging.debug(f"Not writing validation result {state} of {viz_id}, it was evicted")
+
+
+def get_result(viz_id):
+    """
+    Returns the validation result of a visualization, or None if its file was
+    validated when it was loaded.
+    """
+    try:
+        with open(cache.get_cache_root() / viz_id / VALIDATION_FILENAME) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
@@ -0,0 +1,44 @@
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import config
+
+"""
+Pool of worker processes for CPU-bound work like frame decoding, so that it
+can use more than one core. Functions run on the pool must be defined at module
+level so they can be pickled.
+"""
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn rather than fork, the server process is multi-threaded
+            _pool = ProcessPoolExecutor(max_workers=config.DECODE_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def parallel_map(fn, *iterables):
+    """
+    Like map(), but runs on the process pool and returns a list with the results
+    in order. Runs serially when the pool is disabled or has broken down.
+    """
+    global _pool
+    if config.DECODE_WORKERS < 2:
+        return list(map(fn, *iterables))
+    iterables = [list(it) for it in iterables]
+    try:
+        return list(get_pool().map(fn, *iterables))
+    except BrokenProcessPool:
+        logging.exception("Worker process pool broke down, running serially")
+        with _pool_lock:
+            _pool = None
+        return list(map(fn, *iterables))
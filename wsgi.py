@@ -0,0 +1,12 @@
+"""
+Production entry point. Run the visualizer with any WSGI server, e.g.
+
+    gunicorn --workers 4 --threads 4 --bind 0.0.0.0:5000 wsgi:app
+
+All workers share the cache directory set by MMIF_VIZ_CACHE_DIR. Set
+MMIF_VIZ_SECRET_KEY as well, so that session messages survive being served
+by a different worker.
+"""
+from app import app, setup
+
+setup()